@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import logging
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging.handlers import RotatingFileHandler
 
 import dotenv
-import openai
 
+INVOCATION_DIR = os.getcwd()
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 dotenv.load_dotenv('secrets.env')
-openai.api_key = os.environ['OPENAI_API_KEY']
 
 logging.basicConfig(
     handlers=[RotatingFileHandler('agent.log', maxBytes=1000000, backupCount=10)],
@@ -37,16 +40,152 @@ logging.getLogger().addHandler(stream_handler)
 logger = logging.getLogger(__name__)
 
 
-def main():
+def make_stub_wikipedia(path):
+    from agent.tools.wikipedia import Wikipedia
+
+    with open(path) as f:
+        pages = json.load(f)
+
+    class StubWikipedia(Wikipedia):
+        # Answers from a {title: extract} file instead of the Wikipedia API, for reproducible runs
+        def _search_page(self, page):
+            return next((title for title in pages if page.lower() in title.lower()), None)
+
+        def _query_extracts(self, titles, kind, batch_size, extra_params):
+            return {title: (pages[title] if kind == 'full' else pages[title].split('\n==')[0].strip())
+                    if title in pages else None for title in titles}
+
+    return StubWikipedia
+
+
+def make_tools(args):
+    from agent.agent import Agent  # noqa: F401, registers the default tools
+    from agent.tools.python import Python
+    from agent.tools.registry import registry, load_plugins
+
+    load_plugins(args.plugin)
+    tools = registry.get_tools()
+    if not args.batch:
+        tools['PYTHON'] = Python(require_manual_approval=True)
+    if args.wikipedia_stub:
+        tools['WIKIPEDIA'] = make_stub_wikipedia(args.wikipedia_stub)()
+    return tools
+
+
+def make_agent(args, tools):
     from agent.agent import Agent
+    from server.openai_client import get_openai_client
 
+    return Agent(
+        get_openai_client(),
+        args.model,
+        tools,
+        usage_context={'purpose': 'benchmark' if args.batch else 'agent-main'},
+        trace_path=args.trace,
+    )
+
+
+def run_batch_prompt(args, tools, index, entry):
+    agent = make_agent(args, tools)
+    start = time.time()
+    error = None
+    try:
+        answer = agent.process_prompt(entry['prompt'], deadline=args.deadline)
+    except Exception as e:
+        logger.error('Prompt %s failed', index, exc_info=e)
+        answer = None
+        error = str(e)
+    records = agent.last_trace.records()
+    llm_records = [x for x in records if x['span'] == 'llm']
+    return {
+        'id': entry.get('id', index),
+        'prompt': entry['prompt'],
+        'answer': answer,
+        'error': error,
+        'outcome': records[0].get('outcome'),
+        'duration': round(time.time() - start, 3),
+        'steps': len(llm_records),
+        'llm_seconds': round(sum(x['duration'] for x in llm_records), 3),
+        'tool_seconds': round(sum(x['duration'] for x in records if x['span'] == 'tool'), 3),
+        'prompt_tokens': sum(x.get('prompt_tokens', 0) for x in llm_records),
+        'completion_tokens': sum(x.get('completion_tokens', 0) for x in llm_records),
+    }
+
+
+def run_batch(args):
+    with open(args.batch) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    logger.info('Run %s prompts with concurrency %s', len(entries), args.concurrency)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    tools = make_tools(args)
+    start = time.time()
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(run_batch_prompt, args, tools, index, entry)
+                       for index, entry in enumerate(entries)]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+    finally:
+        if args.output:
+            output.close()
+    total = time.time() - start
+    durations = sorted(x['duration'] for x in results)
+    if not durations:
+        return
+    print(json.dumps({
+        'prompts': len(results),
+        'answered': sum(1 for x in results if x['answer'] is not None),
+        'seconds': round(total, 3),
+        'prompts_per_minute': round(len(results) / total * 60, 2),
+        'p50_seconds': durations[len(durations) // 2],
+        'p95_seconds': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'avg_steps': round(sum(x['steps'] for x in results) / len(results), 2),
+        'prompt_tokens': sum(x['prompt_tokens'] for x in results),
+        'completion_tokens': sum(x['completion_tokens'] for x in results),
+    }), file=sys.stderr)
+
+
+def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('prompt', type=lambda s: s.strip(), nargs='+', help='Prompt message')
+    parser.add_argument('prompt', type=lambda s: s.strip(), nargs='*', help='Prompt message')
+    parser.add_argument('--batch', help='JSONL file with one {"prompt": ..., "id": ...} object per line')
+    parser.add_argument('--output', help='JSONL file for the batch results, defaults to stdout')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of prompts to run in parallel')
+    parser.add_argument('--model', default='gpt-3.5-turbo', help='Model to use')
+    parser.add_argument('--deadline', type=float, help='Deadline in seconds for every prompt')
+    parser.add_argument('--trace', help='JSONL file to append the agent traces to')
+    parser.add_argument('--openai-base-url', help='Use a different OpenAI compatible endpoint, e.g. a local stub')
+    parser.add_argument('--wikipedia-stub', help='JSON file with {title: extract} to use instead of Wikipedia')
+    parser.add_argument('--plugin', action='append', default=[], help='Module which registers additional tools')
     args = parser.parse_args()
-    prompt = ' '.join(args.prompt)
+    if not args.prompt and not args.batch:
+        parser.error('Either a prompt or --batch is required')
+    # Paths are relative to where the script was called, not the project root
+    for path_arg in ['batch', 'output', 'trace', 'wikipedia_stub']:
+        if getattr(args, path_arg):
+            setattr(args, path_arg, os.path.join(INVOCATION_DIR, getattr(args, path_arg)))
+
+    if args.openai_base_url:
+        from consts import BENCHMARK_USAGE_LEDGER_PATH, BENCHMARK_COMPLETION_CACHE_DIR
+        from server.completion_cache import use_completion_cache
+        from server.usage_ledger import use_usage_ledger
+
+        # Read by the OpenAI client. The real key from secrets.env must never be sent to another endpoint.
+        os.environ['OPENAI_BASE_URL'] = args.openai_base_url
+        os.environ['OPENAI_API_KEY'] = 'stub'
+        use_usage_ledger(BENCHMARK_USAGE_LEDGER_PATH)
+        use_completion_cache(BENCHMARK_COMPLETION_CACHE_DIR)
+
+    if args.batch:
+        run_batch(args)
+        return
 
-    agent = Agent()
-    result = agent.process_prompt(prompt)
+    agent = make_agent(args, make_tools(args))
+    result = agent.process_prompt(' '.join(args.prompt), deadline=args.deadline)
     print(result)
 
 
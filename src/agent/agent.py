@@ -1,9 +1,13 @@
 import datetime
 import logging
 import re
+import time
+from concurrent.futures import Future, TimeoutError
 
 from agent.tools.python import Python
+from agent.tools.registry import registry, register_tool
 from agent.tools.wikipedia import Wikipedia
+from agent.tracing import Trace
 
 INITIAL_PROMPT = '' \
                  'You are a friendly assistant.\n' \
@@ -13,67 +17,174 @@ INITIAL_PROMPT = '' \
                  'You do not need to ask for permission to use the tools.\n' \
                  'Always use a tool if you are not completely sure about the answer.\n' \
                  'When you use a tool, do not include any explanation. End your output after the tool usage.\n' \
+                 'You can use several tools at once if you need more than one result.\n' \
                  'The available tools are described below.'
 
 TOOL_SEARCH = re.compile(r'\[TOOL (?P<tool>[A-Z]+)](?P<arg>.*?)\[/TOOL]', re.DOTALL)
-ALL_TOOLS = {
-    'PYTHON': Python(require_manual_approval=False),
-    # 'SEARCH': Search(),
-    'WIKIPEDIA': Wikipedia()
-}
+TOOL_START = '[TOOL '
+TOOL_END = '[/TOOL]'
+TRUNCATED_NOTE = '\n\n[The answer is incomplete, the agent ran out of time.]'
+register_tool('PYTHON', Python(require_manual_approval=False))
+# register_tool('SEARCH', Search())
+register_tool('WIKIPEDIA', Wikipedia())
 
 logger = logging.getLogger(__name__)
 
 
 class Agent:
 
-    def __init__(self, openai, model, tools=None):
+    def __init__(self, openai, model, tools=None, usage_context=None, trace_path=None):
         self.openai = openai
         self.model = model
-        self.tools = ALL_TOOLS if tools is None else tools
+        self.tools = registry.get_tools() if tools is None else tools
+        self.usage_context = usage_context
+        self.trace_path = trace_path
+        self.last_trace = None
 
-    def process_prompt(self, prompt, limit=4, previous_messages=None, update_notifier=None):
+    def process_prompt(self, prompt, limit=4, previous_messages=None, update_notifier=None, deadline=None):
         logger.info('Start prompt "%s"', prompt)
-        system_prompt = INITIAL_PROMPT.format(date=datetime.datetime.now().strftime("%Y-%m-%d"))
-        for name, tool in self.tools.items():
-            system_prompt += '\n\n# ' + name + \
-                             '\nDescription: ' + tool.description() + \
-                             '\nUsage: ' + tool.usage() + \
-                             '\nExamples:\n' + '\n'.join(tool.examples())
+        trace = Trace(model=self.model, prompt_chars=len(prompt))
+        self.last_trace = trace
+        end_time = time.time() + deadline if deadline else None
+        try:
+            response, outcome, steps = self._process_prompt(
+                trace, end_time, prompt, limit, previous_messages or [], update_notifier)
+        except Exception as e:
+            trace.finish(outcome='error', error=str(e))
+            raise
+        else:
+            trace.finish(outcome=outcome, steps=steps)
+        finally:
+            logger.info('Agent finished with %s after %.1f seconds: %s', trace.root.attributes['outcome'],
+                        trace.root.duration(), trace.summary())
+            if self.trace_path:
+                trace.export(self.trace_path)
+        return response
+
+    def _process_prompt(self, trace, end_time, prompt, limit, previous_messages, update_notifier):
+        system_prompt = INITIAL_PROMPT.format(date=datetime.datetime.now().strftime("%Y-%m-%d")) + \
+            registry.tool_prompt(self.tools)
+        states = {name: tool.new_state() for name, tool in self.tools.items()}
         messages = [
             {'role': 'system', 'content': system_prompt}
         ]
-        if previous_messages is None:
-            previous_messages = []
-        for _ in range(limit):
-            response = self._gpt(messages + previous_messages + [{'role': 'user', 'content': prompt}])
+        for step in range(limit):
+            if end_time is not None and time.time() >= end_time:
+                logger.warning('Agent ran out of time before it found an answer')
+                return None, 'deadline', step
+            with trace.span('llm', step=step, messages=len(messages) + len(previous_messages) + 1) as span:
+                response = self._gpt(messages + previous_messages + [{'role': 'user', 'content': prompt}],
+                                     end_time, span)
             logger.info('Got response: %s', response)
 
-            match = TOOL_SEARCH.search(response)
-            if not match:
+            matches = list(TOOL_SEARCH.finditer(response))
+            if not self._has_tool_usage(response, span):
+                if span.get('deadline'):
+                    logger.warning('Agent ran out of time while generating the final response')
+                    return (response.strip() + TRUNCATED_NOTE if response.strip() else None), 'deadline', step + 1
                 logger.info('Got final response')
-                return response
-
-            logger.info('Found tool usage for tool %s', match.group('tool'))
-            if update_notifier:
-                update_notifier('[Use tool ' + match.group('tool') + ']')
+                return response, 'answer', step + 1
 
-            tool = self.tools.get(match.group('tool'))
-            if not tool:
-                logger.warning("Tool %s not found", match.group('tool'))
-                messages.append({'role': 'system', 'content': 'The tool "' + match.group('tool') + '" does not exist.'})
+            if not matches:
+                # Only an unfinished tool usage, the next step will end the loop
                 continue
 
-            result = tool.process(match.group('arg'))
-            logger.info('Tool result: %s', result)
-            messages.append({'role': 'system', 'content': tool.format_result(match.group(), result)})
+            tool_names = [match.group('tool') for match in matches]
+            logger.info('Found tool usage for tools %s', tool_names)
+            if update_notifier:
+                update_notifier('[Use tool ' + ', '.join(tool_names) + ']')
+
+            self._prefetch_tools(matches, states)
+            futures = [self._submit_tool(trace, step, match, states) for match in matches]
+            for match, future in zip(matches, futures):
+                try:
+                    result = future.result(timeout=max(0, end_time - time.time()) if end_time else None)
+                except TimeoutError:
+                    logger.warning('Tool %s did not finish in time', match.group('tool'))
+                    result = match.group() + '\nThe tool did not finish in time.'
+                messages.append({'role': 'system', 'content': result})
 
         logger.warning('Did not find answer within %s steps, aborted', limit)
-        return None
+        return None, 'limit', limit
 
-    def _gpt(self, messages):
-        result = self.openai.ChatCompletion.create(
+    def _prefetch_tools(self, matches, states):
+        prompts = {}
+        for match in matches:
+            prompts.setdefault(match.group('tool'), []).append(match.group('arg'))
+        for name, tool_prompts in prompts.items():
+            if name in self.tools and len(tool_prompts) > 1:
+                try:
+                    self.tools[name].prefetch(tool_prompts, states[name])
+                except Exception as e:
+                    logger.warning('Prefetch for tool %s failed', name, exc_info=e)
+
+    def _submit_tool(self, trace, step, match, states):
+        tool = self.tools.get(match.group('tool'))
+        if not tool:
+            logger.warning("Tool %s not found", match.group('tool'))
+            future = Future()
+            future.set_result('The tool "' + match.group('tool') + '" does not exist.')
+            return future
+        # Every tool has its own executor, calls waiting for a busy tool do not hold up the other tools
+        return registry.executor(tool).submit(self._run_tool, trace, step, tool, match, states, time.time())
+
+    def _run_tool(self, trace, step, tool, match, states, submitted):
+        with trace.span('tool', step=step, tool=match.group('tool'), argument_chars=len(match.group('arg'))) as span:
+            span['wait'] = round(time.time() - submitted, 3)
+            result = tool.process(match.group('arg'), states[match.group('tool')])
+            span['result_chars'] = len(str(result)) if result is not None else 0
+        logger.info('Tool result: %s', result)
+        return tool.format_result(match.group(), result, states[match.group('tool')])
+
+    def _gpt(self, messages, end_time=None, span=None):
+        # Streamed so the generation can stop after a complete tool usage. Nothing is forwarded to the user while
+        # streaming, the text before a tool usage is not meant for them.
+        response = ''
+        span = {} if span is None else span
+        start = time.time()
+        stream = self.openai.chat_stream(
+            usage_context=self.usage_context,
+            usage_callback=lambda prompt_tokens, completion_tokens: span.update(
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens),
+            # Also bounds the wait for the first token, which the loop below cannot check
+            deadline=end_time,
             model=self.model,
             messages=messages
         )
-        return result.choices[0].message.content
+        try:
+            for delta in stream:
+                if 'first_token' not in span:
+                    span['first_token'] = round(time.time() - start, 3)
+                response += delta
+                if self._tool_usage_finished(response):
+                    logger.info('Found complete tool usage, stop generating')
+                    span['stopped_early'] = True
+                    break
+                if end_time is not None and time.time() >= end_time:
+                    logger.warning('Agent ran out of time while generating')
+                    span['deadline'] = True
+                    last_bracket = response.rfind('[')
+                    if last_bracket >= 0 and TOOL_START.startswith(response[last_bracket:]):
+                        response = response[:last_bracket]
+                    break
+        except Exception:
+            if end_time is None or time.time() < end_time:
+                raise
+            logger.warning('Request timed out at the deadline')
+            span['deadline'] = True
+        finally:
+            stream.close()
+        span['response_chars'] = len(response)
+        return response
+
+    def _has_tool_usage(self, response, span):
+        # A tool usage might have been cut off by the deadline
+        return bool(TOOL_SEARCH.search(response)) or span.get('deadline', False) and TOOL_START.strip() in response
+
+    def _tool_usage_finished(self, response):
+        last_end = response.rfind(TOOL_END)
+        if last_end < 0:
+            return False
+        # The model might continue with more tool usages, anything else is not needed
+        tail = response[last_end + len(TOOL_END):].lstrip()
+        return bool(tail) and not tail.startswith(TOOL_START) and not TOOL_START.startswith(tail)
@@ -0,0 +1,33 @@
+import math
+import re
+from collections import Counter
+
+TOKEN_SEARCH = re.compile(r'\w+')
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text):
+    return TOKEN_SEARCH.findall(text.lower())
+
+
+def rank(query, documents):
+    query_tokens = set(tokenize(query))
+    document_tokens = [Counter(tokenize(document)) for document in documents]
+    if not query_tokens or not documents:
+        return [0.0] * len(documents)
+    average_length = sum(sum(tokens.values()) for tokens in document_tokens) / len(documents) or 1
+    scores = []
+    for tokens in document_tokens:
+        length = sum(tokens.values())
+        score = 0.0
+        for token in query_tokens:
+            frequency = tokens[token]
+            if not frequency:
+                continue
+            containing = sum(1 for x in document_tokens if token in x)
+            idf = math.log(1 + (len(documents) - containing + 0.5) / (containing + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        scores.append(score)
+    return scores
@@ -1,19 +1,45 @@
 import ast
+import hashlib
 import logging
+import marshal
+import threading
+import time
+from collections import OrderedDict
 
-from agent.tools.timeout import run_with_time_limit
+from agent.tools.sandbox import get_sandbox_pool, SANDBOX_WORKERS
 from agent.tools.tool import Tool
 
 logger = logging.getLogger(__name__)
 
 BLOCKED_BUILTIN_CALLS = {'open', 'eval', 'exec', 'input', 'breakpoint', 'compile', 'help', '__import__'}
 ALLOWED_MODULE_IMPORTS = {'datetime', 'calendar', 'dateutil', 'random'}
+SANDBOX_PRELOAD_MODULES = sorted(ALLOWED_MODULE_IMPORTS) + ['dateutil.parser', 'dateutil.relativedelta', 'dateutil.tz']
+NONDETERMINISTIC_MODULES = {'random'}
+NONDETERMINISTIC_NAMES = {'now', 'today', 'utcnow', 'time', 'monotonic', 'perf_counter', 'random', 'randint', 'choice',
+                          'shuffle', 'sample', 'uniform', 'getrandbits', 'urandom', 'uuid4', 'tzlocal'}
+PYTHON_COMPILED_CACHE_ENTRIES = 256
+PYTHON_RESULT_CACHE_ENTRIES = 256
+PYTHON_RESULT_CACHE_SECONDS = 5 * 60
+
+# Shared by all instances, keyed by the hash of the code
+_cache_lock = threading.Lock()
+_compiled_cache = OrderedDict()
+_result_cache = OrderedDict()
+
+
+class CompiledCode:
+
+    def __init__(self, allowed, deterministic=False, code=None):
+        self.allowed = allowed
+        self.deterministic = deterministic
+        self.code = code
 
 
 class Python(Tool):
 
-    def __init__(self, require_manual_approval=True):
+    def __init__(self, require_manual_approval=True, cache_results=True):
         self.require_manual_approval = require_manual_approval
+        self.cache_results = cache_results
 
     def description(self):
         return 'Execute python code.'
@@ -30,7 +56,7 @@ class Python(Tool):
             '[TOOL PYTHON]import datetime\nnow = datetime.datetime.now()\nprint(now.strftime("%H:%M:%S"))[/TOOL]'
         ]
 
-    def process(self, prompt):
+    def process(self, prompt, state=None):
         logger.info('Assistant wants to execute the following code:\n%s', prompt)
         if not self._sanitize_code(prompt):
             logger.warning('Code execution was automatically blocked')
@@ -42,11 +68,15 @@ class Python(Tool):
                 return '<execution blocked>'
         return self._execute_code(prompt)
 
-    def format_result(self, prompt, result):
+    def format_result(self, prompt, result, state=None):
         if isinstance(result, Exception):
-            f'{prompt}\nThis code failed to run: {result}\nPlease fix the code and try again.'
+            return f'{prompt}\nThis code failed to run: {result}\nPlease fix the code and try again.'
         return f'{prompt}\nThe result of this code is {result}'
 
+    def max_concurrency(self):
+        # More calls than sandbox workers would only wait for a worker inside the pool
+        return 1 if self.require_manual_approval else SANDBOX_WORKERS
+
     def _is_allowed_module(self, module):
         logger.info('Check import for module %s', module)
         if module in ALLOWED_MODULE_IMPORTS:
@@ -56,18 +86,39 @@ class Python(Tool):
         return False
 
     def _sanitize_code(self, code):
+        return self._compile_code(code).allowed
+
+    def _compile_code(self, code):
+        key = hashlib.sha256(code.encode()).hexdigest()
+        with _cache_lock:
+            if key in _compiled_cache:
+                _compiled_cache.move_to_end(key)
+                return _compiled_cache[key]
+        compiled = self._analyze_code(code)
+        with _cache_lock:
+            _compiled_cache[key] = compiled
+            while len(_compiled_cache) > PYTHON_COMPILED_CACHE_ENTRIES:
+                _compiled_cache.popitem(last=False)
+        return compiled
+
+    def _analyze_code(self, code):
         tool_self = self
 
         class SanitizationVisitor(ast.NodeVisitor):
             error_msg = []
+            deterministic = True
 
             def visit_Import(self, node):
+                if any(x.name.split('.')[0] in NONDETERMINISTIC_MODULES for x in node.names):
+                    self.deterministic = False
                 if all(tool_self._is_allowed_module(ast.unparse(x)) for x in node.names):
                     self.generic_visit(node)
                     return
                 self.error_msg.append('Found import: ' + ast.unparse(node))
 
             def visit_ImportFrom(self, node):
+                if (node.module or '').split('.')[0] in NONDETERMINISTIC_MODULES:
+                    self.deterministic = False
                 if tool_self._is_allowed_module(node.module):
                     self.generic_visit(node)
                     return
@@ -78,30 +129,50 @@ class Python(Tool):
                     self.error_msg.append('Found blocked builtin: ' + ast.unparse(node))
                 self.generic_visit(node)
 
+            def visit_Attribute(self, node):
+                if node.attr in NONDETERMINISTIC_NAMES:
+                    self.deterministic = False
+                self.generic_visit(node)
+
+            def visit_Name(self, node):
+                if node.id in NONDETERMINISTIC_NAMES:
+                    self.deterministic = False
+                self.generic_visit(node)
+
         logger.info('Run code through sanitization')
         try:
             parsed = ast.parse(code)
         except SyntaxError as e:
             logger.warning('Code has a syntax error: %s', e)
-            return False
+            return CompiledCode(False)
         visitor = SanitizationVisitor()
         visitor.visit(parsed)
         if visitor.error_msg:
             logger.warning('Code failed sanitization: %s', visitor.error_msg)
-            return False
-        return True
+            return CompiledCode(False)
+        # Code objects cannot be pickled, so they are sent to the sandbox marshalled
+        return CompiledCode(True, visitor.deterministic, marshal.dumps(compile(parsed, '<tool>', 'exec')))
 
     def _execute_code(self, code):
         logger.info('Going to execute the code')
+        compiled = self._compile_code(code)
+        cache_key = hashlib.sha256(code.encode()).hexdigest()
+        if self.cache_results and compiled.deterministic:
+            with _cache_lock:
+                cached = _result_cache.get(cache_key)
+            if cached is not None and cached[0] + PYTHON_RESULT_CACHE_SECONDS > time.time():
+                logger.info('Use cached result: %s', cached[1])
+                return cached[1]
         try:
-            def run_code():
-                env = {}
-                # It's important that locals and globals are the same object
-                exec(code, env, env)
-
-            result = run_with_time_limit(30, run_code)
+            result = get_sandbox_pool(SANDBOX_PRELOAD_MODULES).run(compiled.code, 30)
         except Exception as e:
             logger.warning('Code failed to run: %s', e)
             return e
         logger.info('Got the following result: %s', result)
+        if self.cache_results and compiled.deterministic:
+            with _cache_lock:
+                _result_cache[cache_key] = (time.time(), result)
+                _result_cache.move_to_end(cache_key)
+                while len(_result_cache) > PYTHON_RESULT_CACHE_ENTRIES:
+                    _result_cache.popitem(last=False)
         return result
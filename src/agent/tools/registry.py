@@ -0,0 +1,62 @@
+import importlib
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ToolRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tools = {}
+        self.tool_prompts = {}
+        self.executors = weakref.WeakKeyDictionary()
+
+    def register(self, name, tool):
+        with self.lock:
+            if name in self.tools:
+                logger.warning('Replace tool %s', name)
+            self.tools[name] = tool
+            self.tool_prompts.clear()
+
+    def get_tools(self):
+        with self.lock:
+            return dict(self.tools)
+
+    def tool_prompt(self, tools):
+        # Tools are shared, so the prompt only changes when the set of tools changes. Ids of collected tools are
+        # reused, so the class identifies the tool.
+        key = tuple((name, type(tool)) for name, tool in tools.items())
+        with self.lock:
+            if key not in self.tool_prompts:
+                self.tool_prompts[key] = ''.join(
+                    '\n\n# ' + name +
+                    '\nDescription: ' + tool.description() +
+                    '\nUsage: ' + tool.usage() +
+                    '\nExamples:\n' + '\n'.join(tool.examples())
+                    for name, tool in tools.items())
+            return self.tool_prompts[key]
+
+    def executor(self, tool):
+        with self.lock:
+            if tool not in self.executors:
+                self.executors[tool] = ThreadPoolExecutor(max_workers=tool.max_concurrency(),
+                                                          thread_name_prefix='agent-tool')
+            return self.executors[tool]
+
+
+registry = ToolRegistry()
+
+
+def register_tool(name, tool):
+    registry.register(name, tool)
+
+
+def load_plugins(modules):
+    # Plugin modules register their tools with register_tool when they are imported
+    for module in modules:
+        logger.info('Load agent plugin %s', module)
+        importlib.import_module(module)
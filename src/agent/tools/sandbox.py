@@ -0,0 +1,154 @@
+import importlib
+import logging
+import marshal
+import multiprocessing
+import resource
+import sys
+import threading
+import traceback
+from io import StringIO
+from queue import Queue, Empty
+
+from agent.tools.timeout import TimeoutException
+
+logger = logging.getLogger(__name__)
+
+SANDBOX_WORKERS = 2
+SANDBOX_MAX_MEMORY_BYTES = 512 * 1024 * 1024
+SANDBOX_CPU_SECONDS = 10
+SANDBOX_MAX_OUTPUT_CHARS = 10000
+SANDBOX_ACQUIRE_TIMEOUT_SECONDS = 30
+
+
+class SandboxError(Exception):
+    pass
+
+
+class LimitedStringIO(StringIO):
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.truncated = False
+
+    def write(self, s):
+        remaining = self.limit - self.tell()
+        if len(s) > remaining:
+            self.truncated = True
+            s = s[:max(0, remaining)]
+        return super().write(s)
+
+
+def _worker_main(conn, preload_modules, max_memory, cpu_seconds, max_output):
+    for module in preload_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    # A worker runs a single snippet, code can change builtins and modules which must not leak to the next run
+    try:
+        code = conn.recv()
+    except EOFError:
+        return
+    # The CPU limit is cumulative for the process, so it starts from what the worker used so far
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    used_seconds = int(used.ru_utime + used.ru_stime) + 1
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_CPU)
+    soft_limit = used_seconds + cpu_seconds
+    if hard_limit != resource.RLIM_INFINITY:
+        soft_limit = min(soft_limit, hard_limit)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, hard_limit))
+
+    sys.stdout = buffer = LimitedStringIO(max_output)
+    try:
+        env = {}
+        if isinstance(code, bytes):
+            code = marshal.loads(code)
+        # It's important that locals and globals are the same object
+        exec(code, env, env)
+        output = buffer.getvalue().strip()
+        if buffer.truncated:
+            output += '\n<output truncated>'
+        result = ('ok', output)
+    except BaseException as e:
+        result = ('error', f'{type(e).__name__}: {e}', traceback.format_exc())
+    finally:
+        sys.stdout = sys.__stdout__
+    conn.send(result)
+
+
+class SandboxWorker:
+
+    def __init__(self, context, preload_modules):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, preload_modules, SANDBOX_MAX_MEMORY_BYTES, SANDBOX_CPU_SECONDS,
+                  SANDBOX_MAX_OUTPUT_CHARS),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+
+    def __init__(self, size, preload_modules):
+        self.size = size
+        self.preload_modules = list(preload_modules)
+        # The forkserver is a fresh interpreter, so workers do not inherit the memory of the server
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload([__name__] + self.preload_modules)
+        self.idle = Queue()
+        for _ in range(size):
+            self._start_worker()
+
+    def run(self, code, seconds):
+        try:
+            worker = self.idle.get(timeout=SANDBOX_ACQUIRE_TIMEOUT_SECONDS)
+        except Empty:
+            raise SandboxError('No sandbox worker available.')
+        try:
+            worker.conn.send(code)
+            if not worker.conn.poll(seconds):
+                self._replace_worker(worker)
+                raise TimeoutException('Code timed out.')
+            result = worker.conn.recv()
+        except (EOFError, OSError):
+            # The worker was killed, most likely by the cpu or memory limit
+            self._replace_worker(worker)
+            raise SandboxError('Code exceeded the resource limits.')
+        # Workers are forked from the forkserver with the preloaded modules, so a fresh one is cheap
+        self._replace_worker(worker)
+        if result[0] == 'error':
+            logger.info('Sandbox code failed:\n%s', result[2])
+            raise SandboxError(result[1])
+        return result[1]
+
+    def _start_worker(self):
+        try:
+            self.idle.put(SandboxWorker(self.context, self.preload_modules))
+        except Exception as e:
+            logger.error('Could not start sandbox worker', exc_info=e)
+
+    def _replace_worker(self, worker):
+        worker.kill()
+        threading.Thread(target=self._start_worker, daemon=True).start()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool(preload_modules):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool(SANDBOX_WORKERS, preload_modules)
+        return _pool
@@ -16,10 +16,14 @@ class Search(Tool):
             '[TOOL SEARCH]Election results France[/TOOL]'
         ]
 
-    def process(self, prompt):
+    def process(self, prompt, state=None):
         print('Assistant wants to search for', prompt)
         answer = input('Please enter result: ')
         return answer
 
-    def format_result(self, prompt, result):
+    def format_result(self, prompt, result, state=None):
         return prompt + '\nHere are the search results: ' + result
+
+    def max_concurrency(self):
+        # Asks for the result on the console
+        return 1
@@ -16,9 +16,21 @@ class Tool(ABC):
         pass
 
     @abstractmethod
-    def process(self, prompt):
+    def process(self, prompt, state=None):
         pass
 
     @abstractmethod
-    def format_result(self, prompt, result):
+    def format_result(self, prompt, result, state=None):
+        pass
+
+    def new_state(self):
+        # Tool instances are shared, state for a single conversation goes in here
+        return None
+
+    def max_concurrency(self):
+        # Calls beyond this wait for a running one. The limit applies to all conversations together, as they
+        # share the tool instance and whatever it calls.
+        return 4
+
+    def prefetch(self, prompts, state=None):
         pass
@@ -1,18 +1,52 @@
 import logging
+import re
+import threading
 
 import requests
 
+from agent.tools.bm25 import rank
 from agent.tools.tool import Tool
+from cache import DiskCache
 
 logger = logging.getLogger(__name__)
 
+WIKIPEDIA_API_URL = 'https://en.wikipedia.org/w/api.php'
+WIKIPEDIA_TIMEOUT_SECONDS = 10
+WIKIPEDIA_MAX_BATCH_TITLES = 20
+WIKIPEDIA_CACHE_DIR = 'cache/wikipedia'
+WIKIPEDIA_CACHE_MEMORY_ENTRIES = 512
+WIKIPEDIA_CACHE_MAX_DISK_BYTES = 128 * 1024 * 1024
+WIKIPEDIA_CACHE_TTL_SECONDS = 60 * 60 * 24
+# Requests of all conversations together, the API asks clients to keep the number of parallel requests low
+WIKIPEDIA_MAX_CONCURRENCY = 8
+SECTION_HEADER = re.compile(r'^(=+)\s*(?P<title>.+?)\s*\1$')
 
-class Wikipedia(Tool):
+_session = requests.Session()
+_session.headers['User-Agent'] = 'TeleGPT (https://github.com/SmBe19/TeleGPT)'
+_cache = None
+_cache_lock = threading.Lock()
 
-    def __init__(self, max_length=2048):
+
+def get_wikipedia_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiskCache(WIKIPEDIA_CACHE_DIR, WIKIPEDIA_CACHE_MEMORY_ENTRIES, WIKIPEDIA_CACHE_MAX_DISK_BYTES,
+                               WIKIPEDIA_CACHE_TTL_SECONDS)
+        return _cache
+
+
+class WikipediaState:
+
+    def __init__(self):
         self.searched_pages = set()
         self.searched_full_pages = set()
         self.search_redirects = {}
+
+
+class Wikipedia(Tool):
+
+    def __init__(self, max_length=2048):
         self.max_length = max_length
 
     def description(self):
@@ -20,42 +54,108 @@ class Wikipedia(Tool):
 
     def usage(self):
         return 'Include [TOOL WIKIPEDIA]<topic>[/TOOL] in your response and I will provide you ' \
-               'with the current Wikipedia page for this topic.'
+               'with the current Wikipedia page for this topic. ' \
+               'Include [TOOL WIKIPEDIA]<topic>#<keywords>[/TOOL] to get the sections of the article ' \
+               'which are most relevant for the keywords.'
 
     def examples(self):
         return [
             '[TOOL WIKIPEDIA]Glasgow[/TOOL]',
+            '[TOOL WIKIPEDIA]Glasgow#population 2020[/TOOL]',
             '[TOOL WIKIPEDIA]2022 French presidential election[/TOOL]'
         ]
 
-    def process(self, prompt, perform_search=True):
+    def new_state(self):
+        return WikipediaState()
+
+    def max_concurrency(self):
+        return WIKIPEDIA_MAX_CONCURRENCY
+
+    def process(self, prompt, state=None):
         logger.info('Going to search Wikipedia for "%s"', prompt)
-        if prompt in self.searched_pages:
-            self.searched_full_pages.add(prompt)
-            if prompt in self.search_redirects:
-                prompt = self.search_redirects[prompt]
-            return self._limit_output(self._query_fullpage(prompt))
-        self.searched_pages.add(prompt)
-        result = self._limit_output(self._query_intro(prompt))
-        if result is None and perform_search:
+        state = state or WikipediaState()
+        topic, _, query = (x.strip() for x in prompt.partition('#'))
+        full_page = prompt in state.searched_pages or bool(query)
+        state.searched_pages.add(prompt)
+        if full_page:
+            state.searched_full_pages.add(prompt)
+        page = state.search_redirects.get(prompt, topic)
+        result = self._query_fullpage(page) if full_page else self._query_intro(page)
+        if result is None and prompt not in state.search_redirects:
             logger.warning('Page does not exist, search Wikipedia instead.')
-            search_result = self._search_page(prompt)
+            search_result = self._search_page(topic)
             logger.info('Search result: %s', search_result)
-            if search_result is not None:
-                return self.process(search_result, perform_search=False)
-        return result
-
-    def format_result(self, prompt, result):
+            if search_result is not None and search_result != page:
+                state.search_redirects[prompt] = search_result
+                result = self._query_fullpage(search_result) if full_page else self._query_intro(search_result)
+        if result is None:
+            return None
+        if full_page:
+            return self._select_sections(result, query)
+        return self._limit_output(result)
+
+    def prefetch(self, prompts, state=None):
+        # Introductions can be fetched for several pages in one request
+        searched_pages = state.searched_pages if state else set()
+        # The topic is normalized like in process, so the introductions are cached under the same key
+        topics = [prompt.partition('#')[0].strip() for prompt in prompts
+                  if prompt not in searched_pages and '#' not in prompt]
+        self._query_intros([topic for topic in topics if topic])
+
+    def format_result(self, prompt, result, state=None):
+        state = state or WikipediaState()
+        # The prompt is the whole tool usage, the state is stored by its argument
+        argument = prompt[prompt.find(']') + 1:prompt.rfind('[')] if prompt.startswith('[TOOL') else prompt
         if result is None:
             return prompt + '\nThis page does not exist.'
-        if prompt in self.search_redirects:
+        if argument in state.search_redirects:
             prompt += '\nThis page does not exist, instead I looked up the page "' + \
-                      self.search_redirects[prompt] + '".'
-        if prompt in self.searched_full_pages:
+                      state.search_redirects[argument] + '".'
+        if '#' in argument:
+            return prompt + '\nHere are the sections of the Wikipedia article most relevant for "' + \
+                argument.partition('#')[2].strip() + '".\n' + result
+        if argument in state.searched_full_pages:
             return prompt + '\nHere is the full Wikipedia article.\n' + result
         return prompt + '\nHere is the introduction of the Wikipedia article.\n' \
                         'Repeat the query to get the full article.\n' + result
 
+    def _split_sections(self, text):
+        sections = [('Introduction', [])]
+        for line in text.splitlines():
+            header = SECTION_HEADER.match(line.strip())
+            if header:
+                sections.append((header.group('title'), [line]))
+            else:
+                sections[-1][1].append(line)
+        # Sections which only consist of subsections are dropped, the subsections have their own header
+        return [(title, '\n'.join(lines).strip()) for title, lines in sections
+                if any(line.strip() and not SECTION_HEADER.match(line.strip()) for line in lines)]
+
+    def _select_sections(self, text, query):
+        sections = self._split_sections(text)
+        scores = rank(query, [title + '\n' + content for title, content in sections]) if query else []
+        if not any(scores):
+            # Nothing to rank by, keep the article order
+            return self._limit_output(text)
+        selected = set()
+        total_length = 0
+        for index in sorted(range(len(sections)), key=lambda x: -scores[x]):
+            if scores[index] <= 0:
+                break
+            length = len(sections[index][1].split(' '))
+            if total_length + length > self.max_length:
+                if selected:
+                    continue
+                sections[index] = (sections[index][0], self._limit_output(sections[index][1]))
+                length = self.max_length
+            selected.add(index)
+            total_length += length
+        result = '\n\n'.join(sections[index][1] for index in sorted(selected))
+        other_sections = [title for index, (title, _) in enumerate(sections) if index not in selected]
+        if other_sections:
+            result += '\n\nOther sections: ' + ', '.join(other_sections)
+        return result
+
     def _limit_output(self, text):
         if text is None:
             return text
@@ -70,10 +170,15 @@ class Wikipedia(Tool):
         return text
 
     def _query_wikipedia(self, params):
-        result = requests.get('https://en.wikipedia.org/w/api.php', params=params).json()
-        return result
+        response = _session.get(WIKIPEDIA_API_URL, params=params, timeout=WIKIPEDIA_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        return response.json()
 
     def _search_page(self, page):
+        cache_key = 'search:' + page
+        cached = get_wikipedia_cache().get(cache_key)
+        if cached is not None:
+            return cached['title']
         result = self._query_wikipedia({
             'format': 'json',
             'action': 'opensearch',
@@ -81,41 +186,61 @@ class Wikipedia(Tool):
             'limit': 1,
             'redirects': 'resolve',
         })
-        fixed_name = result[1]
-        if fixed_name:
-            return fixed_name[0]
-        return None
+        fixed_name = result[1][0] if result[1] else None
+        get_wikipedia_cache().put(cache_key, {'title': fixed_name})
+        return fixed_name
 
     def _query_intro(self, page):
-        result = self._query_wikipedia({
-            'format': 'json',
-            'action': 'query',
-            'prop': 'extracts',
-            'titles': page,
-            'redirects': 1,
-            'exsectionformat': 'wiki',
-            'explaintext': 1,
-            'exlimit': 1,
-            'exintro': 1
+        return self._query_intros([page])[page]
+
+    def _query_intros(self, pages):
+        return self._query_extracts(pages, 'intro', WIKIPEDIA_MAX_BATCH_TITLES, {
+            'exlimit': 'max',
+            'exintro': 1,
         })
-        result_page = list(result['query']['pages'].values())[0]
-        if 'missing' in result_page:
-            logger.warning('Page "%s" does not exist', page)
-            return None
-        return result_page['extract']
 
     def _query_fullpage(self, page):
-        result = self._query_wikipedia({
-            'format': 'json',
-            'action': 'query',
-            'prop': 'extracts',
-            'titles': page,
-            'redirects': 1,
-            'exsectionformat': 'wiki',
-            'explaintext': 1,
-        })
-        result_page = list(result['query']['pages'].values())[0]
-        if 'missing' in result_page:
-            logger.warning('Page "%s" does not exist', page)
-            return None
-        return result_page['extract']
+        # Full extracts can only be requested for one page at a time
+        return self._query_extracts([page], 'full', 1, {})[page]
+
+    def _query_extracts(self, pages, kind, batch_size, extra_params):
+        cache = get_wikipedia_cache()
+        extracts = {}
+        missing = []
+        for page in dict.fromkeys(pages):
+            cached = cache.get(kind + ':' + page)
+            if cached is not None:
+                extracts[page] = cached['extract']
+            elif '|' in page:
+                # Not a valid title, and would break the batched query
+                extracts[page] = None
+            else:
+                missing.append(page)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            logger.info('Query %s extracts for %s', kind, batch)
+            result = self._query_wikipedia({
+                'format': 'json',
+                'action': 'query',
+                'prop': 'extracts',
+                'titles': '|'.join(batch),
+                'redirects': 1,
+                'exsectionformat': 'wiki',
+                'explaintext': 1,
+                **extra_params,
+            })
+            query = result.get('query', {})
+            normalized = {x['from']: x['to'] for x in query.get('normalized', [])}
+            redirects = {x['from']: x['to'] for x in query.get('redirects', [])}
+            result_pages = {x.get('title'): x for x in query.get('pages', {}).values()}
+            for page in batch:
+                title = normalized.get(page, page)
+                title = redirects.get(title, title)
+                result_page = result_pages.get(title)
+                if result_page is None or 'missing' in result_page or 'invalid' in result_page:
+                    logger.warning('Page "%s" does not exist', page)
+                    extracts[page] = None
+                else:
+                    extracts[page] = result_page.get('extract')
+                cache.put(kind + ':' + page, {'extract': extracts[page]})
+        return extracts
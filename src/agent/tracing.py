@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class Span:
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+class Trace:
+
+    def __init__(self, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.root = Span('agent', attributes)
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, attributes)
+        with self.lock:
+            self.spans.append(span)
+        try:
+            yield span.attributes
+        except Exception as e:
+            span.attributes['error'] = str(e)
+            raise
+        finally:
+            span.end = time.time()
+
+    def finish(self, **attributes):
+        self.root.attributes.update(attributes)
+        self.root.end = time.time()
+
+    def records(self):
+        with self.lock:
+            spans = [self.root] + self.spans
+        return [{
+            'trace_id': self.trace_id,
+            'span': span.name,
+            'offset': round(span.start - self.root.start, 3),
+            'duration': round(span.duration(), 3),
+            **span.attributes,
+        } for span in spans]
+
+    def summary(self):
+        totals = {}
+        for record in self.records()[1:]:
+            key = record['span'] if 'tool' not in record else 'tool ' + record['tool']
+            totals[key] = round(totals.get(key, 0) + record['duration'], 3)
+        return totals
+
+    def export(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        lines = ''.join(json.dumps(record) + '\n' for record in self.records())
+        with open(path, 'a') as f:
+            f.write(lines)
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+
+    def __init__(self, directory, memory_entries, max_disk_bytes, ttl):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        # file key -> (created, size), ordered by creation time
+        self.disk_index = OrderedDict()
+        self.disk_bytes = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_disk_index()
+
+    def get(self, key):
+        file_key = self._file_key(key)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] + self.ttl > time.time():
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return entry[1]
+            if file_key in self.disk_index and self.disk_index[file_key][0] + self.ttl > time.time():
+                try:
+                    with open(self._path(file_key)) as f:
+                        entry = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning('Could not read cache entry %s', key, exc_info=e)
+                else:
+                    self._put_memory(key, entry['created'], entry['content'])
+                    self.stats['disk_hits'] += 1
+                    return entry['content']
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, content):
+        # None is used to signal a miss, so it cannot be cached
+        if content is None:
+            return
+        file_key = self._file_key(key)
+        created = time.time()
+        data = json.dumps({'created': created, 'content': content})
+        with self.lock:
+            self._put_memory(key, created, content)
+            self._remove_disk(file_key)
+            with open(self._path(file_key), 'w') as f:
+                f.write(data)
+            self.disk_index[file_key] = (created, len(data))
+            self.disk_bytes += len(data)
+            self._evict_disk()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = sum(self.stats.values())
+            hits = self.stats['memory_hits'] + self.stats['disk_hits']
+            return dict(self.stats, hit_rate=hits / lookups if lookups else 0.0, disk_bytes=self.disk_bytes)
+
+    def _put_memory(self, key, created, content):
+        self.memory[key] = (created, content)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _path(self, file_key):
+        return os.path.join(self.directory, f'{file_key}.json')
+
+    @staticmethod
+    def _file_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _remove_disk(self, file_key):
+        if file_key not in self.disk_index:
+            return
+        _, size = self.disk_index.pop(file_key)
+        self.disk_bytes -= size
+        try:
+            os.remove(self._path(file_key))
+        except FileNotFoundError:
+            pass
+
+    def _evict_disk(self):
+        now = time.time()
+        while self.disk_index:
+            file_key, (created, _) = next(iter(self.disk_index.items()))
+            if self.disk_bytes <= self.max_disk_bytes and created + self.ttl > now:
+                break
+            self._remove_disk(file_key)
+
+    def _load_disk_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            entries.append((os.path.getmtime(path), os.path.getsize(path), name[:-len('.json')]))
+        for created, size, file_key in sorted(entries):
+            self.disk_index[file_key] = (created, size)
+            self.disk_bytes += size
+        self._evict_disk()
+        logger.info('Loaded %s cache entries from %s (%s bytes)', len(self.disk_index), self.directory,
+                    self.disk_bytes)
+
+
+class BlobCache:
+    # Binary content on disk, the least recently used entries are evicted first.
+    # Small metadata like the Telegram file id of an upload is kept next to the content.
+
+    def __init__(self, directory, max_disk_bytes, extension):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.extension = extension
+        self.lock = threading.Lock()
+        # file key -> size, least recently used first
+        self.disk_index = OrderedDict()
+        self.disk_bytes = 0
+        self.metadata = {}
+        self.stats = {'metadata_hits': 0, 'disk_hits': 0, 'misses': 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_disk_index()
+
+    def get(self, key):
+        file_key = self._file_key(key)
+        with self.lock:
+            if file_key in self.disk_index:
+                try:
+                    with open(self._path(file_key), 'rb') as f:
+                        content = f.read()
+                except OSError as e:
+                    logger.warning('Could not read cache entry %s', key, exc_info=e)
+                else:
+                    self._touch(file_key)
+                    self.stats['disk_hits'] += 1
+                    return content
+            self.stats['misses'] += 1
+            return None
+
+    def get_metadata(self, key, name=None):
+        # Without a name all metadata of the entry is returned, so a lookup counts as a single hit
+        file_key = self._file_key(key)
+        with self.lock:
+            metadata = self.metadata.get(file_key, {})
+            value = metadata.get(name) if name is not None else dict(metadata) or None
+            if value is not None:
+                self._touch(file_key)
+                self.stats['metadata_hits'] += 1
+            return value
+
+    def put(self, key, content):
+        file_key = self._file_key(key)
+        with self.lock:
+            self._remove_disk(file_key)
+            with open(self._path(file_key), 'wb') as f:
+                f.write(content)
+            self.disk_index[file_key] = len(content)
+            self.disk_bytes += len(content)
+            self._evict_disk()
+
+    def set_metadata(self, key, **values):
+        file_key = self._file_key(key)
+        with self.lock:
+            if file_key not in self.disk_index:
+                return
+            metadata = self.metadata.setdefault(file_key, {})
+            for name, value in values.items():
+                if value is None:
+                    metadata.pop(name, None)
+                else:
+                    metadata[name] = value
+            with open(self._metadata_path(file_key), 'w') as f:
+                json.dump(metadata, f)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = sum(self.stats.values())
+            hits = self.stats['metadata_hits'] + self.stats['disk_hits']
+            return dict(self.stats, hit_rate=hits / lookups if lookups else 0.0, disk_bytes=self.disk_bytes)
+
+    def _touch(self, file_key):
+        self.disk_index.move_to_end(file_key)
+        try:
+            # The modification time restores the order after a restart
+            os.utime(self._path(file_key))
+        except OSError:
+            pass
+
+    def _path(self, file_key):
+        return os.path.join(self.directory, f'{file_key}.{self.extension}')
+
+    def _metadata_path(self, file_key):
+        return os.path.join(self.directory, f'{file_key}.json')
+
+    @staticmethod
+    def _file_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _remove_disk(self, file_key):
+        if file_key not in self.disk_index:
+            return
+        self.disk_bytes -= self.disk_index.pop(file_key)
+        for path in [self._path(file_key), self._metadata_path(file_key)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.metadata.pop(file_key, None)
+
+    def _evict_disk(self):
+        while self.disk_index and self.disk_bytes > self.max_disk_bytes:
+            self._remove_disk(next(iter(self.disk_index)))
+
+    def _load_disk_index(self):
+        entries = []
+        suffix = '.' + self.extension
+        for name in os.listdir(self.directory):
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            entries.append((os.path.getmtime(path), os.path.getsize(path), name[:-len(suffix)]))
+        for _, size, file_key in sorted(entries):
+            self.disk_index[file_key] = size
+            self.disk_bytes += size
+            try:
+                with open(self._metadata_path(file_key)) as f:
+                    self.metadata[file_key] = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logger.warning('Could not read cache metadata %s', file_key, exc_info=e)
+        self._evict_disk()
+        logger.info('Loaded %s cache entries from %s (%s bytes)', len(self.disk_index), self.directory,
+                    self.disk_bytes)
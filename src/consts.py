@@ -11,3 +11,128 @@ MESSAGES_UNTIL_AUTONAME = 4
 MIN_HISTORY_CONTEXT = 2
 TARGET_HISTORY_CONTEXT = 16
 HISTORY_TOKEN_LIMIT = 2800
+
+OPENAI_TIMEOUTS = {
+    'chat': 90,
+    'image': 120,
+    'audio': 60,
+}
+OPENAI_CONNECT_TIMEOUT = 10
+OPENAI_MAX_CONNECTIONS = 32
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 16
+OPENAI_MAX_RETRIES = 3
+OPENAI_BACKOFF_BASE_SECONDS = 1
+OPENAI_BACKOFF_MAX_SECONDS = 30
+
+CIRCUIT_BREAKER_WINDOW_SECONDS = 120
+CIRCUIT_BREAKER_MIN_CALLS = 4
+CIRCUIT_BREAKER_FAILURE_RATE = 0.5
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 60
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = 1
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = {
+    'chat': 60,
+    'image': 90,
+    'audio': 45,
+}
+OPENAI_FALLBACK_MODELS = {
+    'gpt-4': 'gpt-3.5-turbo',
+    'gpt-4-1106-preview': 'gpt-3.5-turbo',
+}
+
+CHAT_HEDGING_ENABLED = True
+CHAT_HEDGING_WORKERS = 16
+CHAT_HEDGING_PERCENTILE = 0.95
+CHAT_HEDGING_MIN_SAMPLES = 20
+CHAT_HEDGING_MIN_DELAY_SECONDS = 2
+CHAT_LATENCY_SAMPLES = 200
+
+COMPLETION_CACHE_DIR = 'cache/completions'
+COMPLETION_CACHE_MEMORY_ENTRIES = 256
+COMPLETION_CACHE_MAX_DISK_BYTES = 64 * 1024 * 1024
+COMPLETION_CACHE_TTL_SECONDS = 60 * 60 * 24 * 7
+
+USAGE_LEDGER_PATH = 'usage/ledger.jsonl'
+# agent-main.py runs against another endpoint must not mix with the usage and cache of the bot
+BENCHMARK_USAGE_LEDGER_PATH = 'benchmark/ledger.jsonl'
+BENCHMARK_COMPLETION_CACHE_DIR = 'benchmark/completions'
+USAGE_REPORT_DAYS = 30
+# USD per 1000 prompt and completion tokens
+USAGE_TOKEN_PRICES = {
+    'gpt-3.5-turbo': (0.001, 0.002),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-1106-preview': (0.01, 0.03),
+}
+# USD per image, per 1000 characters or per minute of audio
+USAGE_UNIT_PRICES = {
+    'dall-e-2': 0.02,
+    'dall-e-3': 0.04,
+    'tts-1': 0.015,
+    'tts-1-hd': 0.03,
+    'whisper-1': 0.006,
+}
+MAX_MESSAGE_LENGTH = 4096
+# Telegram rejects inline buttons with more callback data
+MAX_CALLBACK_DATA_BYTES = 64
+
+THREAD_PAGE_SIZE = 8
+THREAD_RECENT_MAX = 50
+
+UPDATE_DEDUP_PATH = 'state/updates.json'
+UPDATE_DEDUP_SECONDS = 60 * 60 * 24
+UPDATE_DEDUP_BUCKET_SECONDS = 60 * 60
+UPDATE_DEDUP_MAX_UPDATES = 100000
+UPDATE_DEDUP_FLUSH_SECONDS = 10
+UPDATE_DEDUP_LOCK_STRIPES = 16
+
+# Users beyond this are evicted from memory, least recently used first
+USER_CACHE_SIZE = 1000
+USER_SETTINGS_FLUSH_SECONDS = 5
+# Users which were handed out recently are kept, the caller might not have locked them yet
+USER_EVICT_MIN_IDLE_SECONDS = 60
+
+AGENT_DEADLINE_SECONDS = 90
+AGENT_TRACE_PATH = 'traces/agent.jsonl'
+# Modules which register additional agent tools with agent.tools.registry.register_tool
+AGENT_TOOL_PLUGINS = []
+
+MAX_AUDIO_FILE_BYTES = 15 * 1024 * 1024
+# Formats the transcription endpoint accepts without transcoding
+WHISPER_DIRECT_FORMATS = {'flac', 'm4a', 'mp3', 'mp4', 'mpeg', 'mpga', 'oga', 'ogg', 'wav', 'webm'}
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+WHISPER_DOWNLOAD_TIMEOUT_SECONDS = 30
+WHISPER_TRANSCODE_TIMEOUT_SECONDS = 120
+# Larger audio is buffered in a temporary file instead of memory
+AUDIO_SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+# Longer audio is split at silences into segments of at most this length, which are transcribed in parallel
+WHISPER_SEGMENT_SECONDS = 180
+WHISPER_PARALLELISM = 4
+WHISPER_MAX_SEGMENTED_SECONDS = 60 * 60 * 2
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_MIN_SILENCE_MS = 400
+# Relative to the average loudness of the audio
+WHISPER_SILENCE_THRESHOLD_DB = -16
+# Replies are synthesized in chunks of at least this many characters, except the first sentence
+TTS_CHUNK_CHARS = 400
+TTS_MAX_INPUT_CHARS = 4096
+TTS_CACHE_DIR = 'cache/tts'
+TTS_CACHE_MAX_DISK_BYTES = 256 * 1024 * 1024
+
+MEDIA_JOB_WORKERS = {
+    'image': 4,
+    'tts': 4,
+    'transcription': 2,
+}
+# Further jobs of a user wait until one of the running ones is finished
+MEDIA_JOBS_PER_USER = {
+    'image': 2,
+    'tts': 3,
+    'transcription': 1,
+}
+MEDIA_PROGRESS_INTERVAL_SECONDS = 4
+
+IMAGE_CACHE_DIR = 'cache/images'
+IMAGE_CACHE_MAX_DISK_BYTES = 512 * 1024 * 1024
+IMAGE_DOWNLOAD_TIMEOUT_SECONDS = 30
+# OpenAI image URLs expire after an hour
+IMAGE_URL_LIFETIME_SECONDS = 55 * 60
+IMAGE_MAX_VARIANTS = 4
@@ -5,13 +5,12 @@ import threading
 import time
 from queue import Queue, Empty
 
-from openai import OpenAI
-
 from agent.agent import Agent
-from agent.tools.python import Python
-from agent.tools.wikipedia import Wikipedia
 from consts import MAX_WORKER_IDLE_SECONDS, DATA_DIR, SYSTEM_MESSAGES, MESSAGES_UNTIL_AUTONAME, HISTORY_TOKEN_LIMIT, \
-    MIN_HISTORY_CONTEXT, TARGET_HISTORY_CONTEXT
+    MIN_HISTORY_CONTEXT, TARGET_HISTORY_CONTEXT, AGENT_DEADLINE_SECONDS, AGENT_TRACE_PATH
+from server.completion_cache import get_completion_cache
+from server.openai_client import get_openai_client, UpstreamUnavailableError
+from server.thread_index import ThreadIndex
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +26,8 @@ class ChatGPT:
         self.message_processing_thread = None
         self.data = {}
         self.current_thread = {}
-        self.openai = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+        self.thread_index = ThreadIndex({})
+        self.openai = get_openai_client()
         self._load_data()
 
     def is_active(self):
@@ -50,11 +50,20 @@ class ChatGPT:
         self._save_root_data()
 
     def submit_message(self, text):
+        if not self.openai.is_chat_available(self.get_current_model()):
+            logger.warning('Shed message from chat %s, upstream is unavailable', self.user.chatid)
+            self.user.send_message(str(UpstreamUnavailableError()))
+            return
         self.queue.put(lambda: self._process_message(text))
 
-    def get_thread_names(self):
-        return {thread_id: value['name'] for thread_id, value in
-                sorted(self.data['threads'].items(), key=lambda x: x[0])}
+    def get_thread_name(self, thread_id):
+        return self.thread_index.get_name(thread_id)
+
+    def get_recent_threads(self, count, after=None, before=None):
+        return self.thread_index.recent(count, after, before)
+
+    def get_threads_with_prefix(self, prefix, count, offset=0):
+        return self.thread_index.with_prefix(prefix, count, offset)
 
     def new_thread(self, system_message_template):
         self.queue.put(lambda: self._new_thread(system_message_template))
@@ -111,6 +120,7 @@ class ChatGPT:
         if os.path.exists(root_data_path):
             with open(root_data_path) as f:
                 self.data = json.load(f)
+            self.thread_index = ThreadIndex(self.data['threads'])
             self._load_current_thread()
         else:
             self.data = {
@@ -129,6 +139,13 @@ class ChatGPT:
         with open(thread_data_path, 'w') as f:
             json.dump(self.current_thread, f)
 
+    def _usage_context(self, purpose):
+        return {
+            'user': self.user.chatid,
+            'thread': self.get_current_thread_id(),
+            'purpose': purpose,
+        }
+
     def _save_root_data(self):
         root_data_path = os.path.join(DATA_DIR, f'{self.user.chatid}.json')
         with open(root_data_path, 'w') as f:
@@ -171,7 +188,9 @@ class ChatGPT:
             'role': 'user',
             'content': 'Very short topic of our conversation? Only include the topic.'
         })
-        response = self.openai.chat.completions.create(
+        response = get_completion_cache().complete(
+            self.openai,
+            usage_context=self._usage_context('autoname'),
             model=self.current_thread['model'],
             messages=messages,
             logit_bias={
@@ -181,10 +200,10 @@ class ChatGPT:
                 "48902": -2,
             }
         )
-        response = response.choices[0].message.content
         new_name = response.strip('".')
         old_name = self.data['threads'][self.get_current_thread_id()]['name']
         self.data['threads'][self.get_current_thread_id()]['name'] = new_name
+        self.thread_index.rename(self.get_current_thread_id(), new_name)
         self._save_root_data()
         if not silent:
             self.user.send_message(f'Renamed thread "{old_name}" to "{new_name}".')
@@ -215,11 +234,12 @@ class ChatGPT:
                        'Include all details a large language model needs to know to be able to answer questions '
                        'about the text only using the summary.'
         })
-        response = self.openai.chat.completions.create(
+        summary = get_completion_cache().complete(
+            self.openai,
+            usage_context=self._usage_context('summary'),
             model=self.current_thread['model'],
             messages=messages,
         )
-        summary = response.choices[0].message.content
         self.current_thread['summaries'].append({
             'last_message': last_message_in_all_messages,
             'summary': summary,
@@ -238,22 +258,49 @@ class ChatGPT:
         logger.info('Send new message to ChatGPT.')
         self.current_thread['messages'].append({'role': 'user', 'content': message})
         messages = self._get_current_messages()
-        response = self.openai.chat.completions.create(
-            model=self.current_thread['model'],
-            messages=messages,
-        )
+        tts = self.user.create_tts_pipeline()
+        if tts and not self.user.chat_hedging:
+            # Speech synthesis starts with the first sentence instead of waiting for the whole response, the audio is
+            # held back until the text is sent
+            response_text, total_tokens = self._stream_response(messages, tts.add_text)
+        else:
+            create = self.openai.chat_hedged if self.user.chat_hedging else self.openai.chat
+            response = create(
+                usage_context=self._usage_context('chat'),
+                model=self.current_thread['model'],
+                messages=messages,
+            )
+            total_tokens = response.usage.total_tokens
+            response_text = response.choices[0].message.content
+            if tts:
+                tts.add_text(response_text)
         logger.info('Got response from ChatGPT.')
-        logger.debug('Usage for ChatGPT: %s tokens by chat %s', response.usage.total_tokens, self.user.chatid)
-        self.current_thread['total_tokens'] += response.usage.total_tokens
-        response_text = response.choices[0].message.content
+        logger.debug('Usage for ChatGPT: %s tokens by chat %s', total_tokens, self.user.chatid)
+        self.current_thread['total_tokens'] += total_tokens
         self.current_thread['messages'].append({'role': 'assistant', 'content': response_text})
         self._save_current_thread()
-        self.user.send_reply(response_text)
+        self.user.send_message(response_text)
+        if tts:
+            tts.release()
+            tts.finish()
         if self.data['threads'][self.get_current_thread_id()]['name'] == 'Unnamed thread' and \
                 len(self.current_thread['messages']) >= MESSAGES_UNTIL_AUTONAME * 2:
             self._suggest_thread_name(silent=True)
         self._check_summary_needed()
 
+    def _stream_response(self, messages, callback):
+        usage = []
+        response_text = ''
+        for delta in self.openai.chat_stream(
+                usage_context=self._usage_context('chat'),
+                usage_callback=lambda prompt_tokens, completion_tokens: usage.append(prompt_tokens + completion_tokens),
+                model=self.current_thread['model'],
+                messages=messages,
+        ):
+            response_text += delta
+            callback(delta)
+        return response_text, sum(usage)
+
     def _new_thread(self, system_message_template='default', silent=False):
         if system_message_template not in SYSTEM_MESSAGES:
             system_message_template = 'default'
@@ -263,6 +310,7 @@ class ChatGPT:
             'name': 'Unnamed thread',
             'last_use': time.time(),
         }
+        self.thread_index.add(thread_id, 'Unnamed thread')
         self.data['current_thread_id'] = thread_id
         self.current_thread = {
             'model': 'gpt-3.5-turbo',
@@ -280,6 +328,7 @@ class ChatGPT:
     def _rename_thread(self, new_name):
         old_name = self.data['threads'][self.get_current_thread_id()]['name']
         self.data['threads'][self.get_current_thread_id()]['name'] = new_name
+        self.thread_index.rename(self.get_current_thread_id(), new_name)
         self._save_root_data()
         self.user.send_message(f'Renamed thread "{old_name}" to "{new_name}".')
 
@@ -289,6 +338,7 @@ class ChatGPT:
             self._load_current_thread()
             new_name = self.data['threads'][self.get_current_thread_id()]['name']
             self.data['threads'][self.get_current_thread_id()]['last_use'] = time.time()
+            self.thread_index.touch(self.get_current_thread_id())
             self._save_root_data()
             self.user.send_message(f'Switched to thread "{new_name}".')
         else:
@@ -300,14 +350,15 @@ class ChatGPT:
         if len(self.data['threads']) == 0:
             self._new_thread()
         else:
-            latest = max(self.data['threads'].keys(), key=lambda x: self.data['threads'][x]['last_use'])
-            self._switch_thread(latest)
+            threads, _, _ = self.thread_index.recent(1)
+            self._switch_thread(threads[0][0])
 
     def _finish_thread(self):
         old_name = self.data['threads'][self.get_current_thread_id()]['name']
         thread_data_path = self._thread_data_path(self.get_current_thread_id())
         os.remove(thread_data_path)
         del self.data['threads'][self.get_current_thread_id()]
+        self.thread_index.remove(self.get_current_thread_id())
         self._save_root_data()
         self.user.send_message(f'Deleted thread "{old_name}".')
         self._switch_to_latest_thread()
@@ -340,17 +391,16 @@ class ChatGPT:
         my_agent = Agent(
             self.openai,
             self.current_thread['model'],
-            {
-                'PYTHON': Python(require_manual_approval=False),
-                'WIKIPEDIA': Wikipedia()
-            }
+            usage_context=self._usage_context('agent'),
+            trace_path=AGENT_TRACE_PATH,
         )
         previous_messages = self.current_thread['messages'][self._get_current_messages_start():]
         logger.info('Start new agent.')
         response = my_agent.process_prompt(
             prompt,
             previous_messages=previous_messages,
-            update_notifier=lambda update: self.user.send_message(update)
+            update_notifier=lambda update: self.user.send_message(update),
+            deadline=AGENT_DEADLINE_SECONDS,
         )
         logger.info('Got agent response.')
         if response is None:
@@ -388,6 +438,9 @@ class ChatGPT:
             self.last_update = time.time()
             try:
                 item()
+            except UpstreamUnavailableError as e:
+                logger.warning('ChatGPT failed fast, upstream is unavailable')
+                self.user.send_message(str(e))
             except Exception as e:
                 logger.error('ChatGPT failed', exc_info=e)
                 self.user.send_message('Sorry, I crashed. ' + str(e))
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import threading
+
+from cache import DiskCache
+from consts import COMPLETION_CACHE_DIR, COMPLETION_CACHE_MEMORY_ENTRIES, COMPLETION_CACHE_MAX_DISK_BYTES, \
+    COMPLETION_CACHE_TTL_SECONDS
+
+
+class CompletionCache(DiskCache):
+
+    @staticmethod
+    def key(**params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _file_key(key):
+        # Keys are hashes already, hashing them again would orphan the existing cache files
+        return key
+
+    def complete(self, openai, usage_context=None, **params):
+        key = self.key(**params)
+        content = self.get(key)
+        if content is not None:
+            return content
+        response = openai.chat(usage_context=usage_context, **params)
+        content = response.choices[0].message.content
+        # The client falls back to another model while the requested one is unavailable, that answer must not be
+        # served once the model is back. The response reports the model with its version, e.g. gpt-4-0613.
+        if response.model.startswith(params['model']):
+            self.put(key, content)
+        return content
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CompletionCache(COMPLETION_CACHE_DIR, COMPLETION_CACHE_MEMORY_ENTRIES,
+                                     COMPLETION_CACHE_MAX_DISK_BYTES, COMPLETION_CACHE_TTL_SECONDS)
+        return _cache
+
+
+def use_completion_cache(directory):
+    global _cache
+    with _cache_lock:
+        _cache = CompletionCache(directory, COMPLETION_CACHE_MEMORY_ENTRIES, COMPLETION_CACHE_MAX_DISK_BYTES,
+                                 COMPLETION_CACHE_TTL_SECONDS)
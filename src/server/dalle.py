@@ -1,32 +1,118 @@
+import json
 import logging
-import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from openai import OpenAI
+import requests
+
+from cache import BlobCache
+from consts import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_DISK_BYTES, IMAGE_DOWNLOAD_TIMEOUT_SECONDS, IMAGE_MAX_VARIANTS
+from server.openai_client import get_openai_client
 
 logger = logging.getLogger(__name__)
 
+VARIANT_EXECUTOR = ThreadPoolExecutor(max_workers=2 * IMAGE_MAX_VARIANTS, thread_name_prefix='dalle')
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = BlobCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_DISK_BYTES, 'png')
+        return _image_cache
+
+
+class GeneratedImage:
+
+    def __init__(self, key, url, revised_prompt, created, cached):
+        self.key = key
+        self.url = url
+        self.revised_prompt = revised_prompt
+        self.created = created
+        self.cached = cached
+
 
 class DallE:
 
     def __init__(self):
-        self.openai = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+        self.openai = get_openai_client()
+
+    def create_images(self, model, prompt, size, quality, style, variants=1, usage_context=None):
+        if model not in ['dall-e-2', 'dall-e-3']:
+            raise ValueError()
+        # Images are stored locally, the URLs returned by OpenAI expire
+        params = [model, prompt, size, quality, style] if model == 'dall-e-3' else [model, prompt, size]
+        keys = [json.dumps(params + [variant] if variant else params) for variant in range(variants)]
+        cache = get_image_cache()
+        images = {}
+        for variant, key in enumerate(keys):
+            metadata = cache.get_metadata(key)
+            if metadata and 'created' in metadata:
+                images[variant] = GeneratedImage(key, metadata.get('url'), metadata.get('revised_prompt'),
+                                                 metadata['created'], True)
+        missing = [variant for variant in range(variants) if variant not in images]
+        if images:
+            logger.info('Use %s cached images', len(images))
+        futures = {}
+        if model == 'dall-e-2' and missing:
+            # DALL·E 2 creates several images in one request
+            urls = self.generate_image_v2(prompt, size, usage_context, n=len(missing))
+            futures = {variant: VARIANT_EXECUTOR.submit(self._store_image, keys[variant], url, None)
+                       for variant, url in zip(missing, urls)}
+        elif model == 'dall-e-3':
+            # DALL·E 3 only creates one image per request, so the requests are sent in parallel
+            futures = {variant: VARIANT_EXECUTOR.submit(self._create_image_v3, keys[variant], prompt, size, quality,
+                                                        style, usage_context)
+                       for variant in missing}
+        error = None
+        for variant, future in futures.items():
+            try:
+                images[variant] = future.result()
+            except Exception as e:
+                logger.warning('Failed to create image variant %s', variant, exc_info=e)
+                error = error or e
+        if not images and error:
+            raise error
+        return [images[variant] for variant in sorted(images)]
 
-    def generate_image_v2(self, prompt, size):
+    def _create_image_v3(self, key, prompt, size, quality, style, usage_context):
+        url, revised_prompt = self.generate_image_v3(prompt, size, quality, style, usage_context)
+        return self._store_image(key, url, revised_prompt)
+
+    def _store_image(self, key, url, revised_prompt):
+        cache = get_image_cache()
+        created = time.time()
+        try:
+            response = requests.get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT_SECONDS)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning('Failed to download image', exc_info=e)
+            return GeneratedImage(key, url, revised_prompt, created, False)
+        cache.put(key, response.content)
+        cache.set_metadata(key, url=url, revised_prompt=revised_prompt, created=created)
+        return GeneratedImage(key, url, revised_prompt, created, True)
+
+    def generate_image_v2(self, prompt, size, usage_context=None, n=1):
         if str(size) not in ['256x256', '512x512', '1024x1024']:
             logger.warning('Size %s is not supported for image generation, falling back to 256', size)
             size = '256x256'
         logger.info('Generate image of size %s', size)
-        response = self.openai.images.generate(
+        response = self.openai.image(
+            usage_context=usage_context,
             model='dall-e-2',
             prompt=prompt,
-            n=1,
+            n=n,
             response_format='url',
             size=size,
         )
         logger.info('Finished generating image')
-        return response.data[0].url
+        return [image.url for image in response.data]
 
-    def generate_image_v3(self, prompt, size, quality, style):
+    def generate_image_v3(self, prompt, size, quality, style, usage_context=None):
         if str(size) not in ['1024x1024', '1792x1024', '1024x1792']:
             logger.warning('Size %s is not supported for image generation, falling back to 1024', size)
             size = '1024x1024'
@@ -37,7 +123,8 @@ class DallE:
             logger.warning('Quality %s is not supported for image generation, falling back to natural', style)
             style = 'natural'
         logger.info('Generate image of size %s', size)
-        response = self.openai.images.generate(
+        response = self.openai.image(
+            usage_context=usage_context,
             model='dall-e-3',
             prompt=prompt,
             n=1,
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from consts import MEDIA_JOB_WORKERS, MEDIA_JOBS_PER_USER, MEDIA_PROGRESS_INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class MediaJob:
+
+    def __init__(self, kind, user, function, progress):
+        self.kind = kind
+        self.user = user
+        self.function = function
+        self.progress = progress
+        self.future = Future()
+        self.submitted = time.time()
+
+
+class MediaJobs:
+    # Slow media work runs on its own pools, so it does not block chat and command handling
+
+    def __init__(self, workers, jobs_per_user):
+        self.jobs_per_user = jobs_per_user
+        self.executors = {kind: ThreadPoolExecutor(max_workers=count, thread_name_prefix='media-' + kind)
+                          for kind, count in workers.items()}
+        self.lock = threading.Lock()
+        # (kind, user) -> number of jobs handed to the pool
+        self.active = {}
+        # (kind, user) -> jobs over the limit of the user, in submission order
+        self.waiting = {}
+        self.running = set()
+        self.metrics = {kind: {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'wait_seconds': 0.0,
+            'run_seconds': 0.0,
+        } for kind in workers}
+        self.progress_thread = None
+        self.closed = False
+
+    def submit(self, kind, user, function, progress=None):
+        job = MediaJob(kind, user, function, progress)
+        key = (kind, user)
+        with self.lock:
+            if self.closed:
+                job.future.set_exception(RuntimeError('Media jobs are shut down'))
+                return job.future
+            self.metrics[kind]['submitted'] += 1
+            if self.active.get(key, 0) < self.jobs_per_user[kind]:
+                self.active[key] = self.active.get(key, 0) + 1
+                self._dispatch(job)
+            else:
+                self.waiting.setdefault(key, deque()).append(job)
+            if progress and self.progress_thread is None:
+                self.progress_thread = threading.Thread(target=self._report_progress, daemon=True)
+                self.progress_thread.start()
+        return job.future
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = {}
+            for kind, kind_metrics in self.metrics.items():
+                finished = kind_metrics['completed'] + kind_metrics['failed']
+                metrics[kind] = {
+                    'submitted': kind_metrics['submitted'],
+                    'completed': kind_metrics['completed'],
+                    'failed': kind_metrics['failed'],
+                    'running': sum(1 for job in self.running if job.kind == kind),
+                    'waiting': sum(len(jobs) for (job_kind, _), jobs in self.waiting.items() if job_kind == kind),
+                    'avg_wait_seconds': round(kind_metrics['wait_seconds'] / finished, 3) if finished else 0,
+                    'avg_run_seconds': round(kind_metrics['run_seconds'] / finished, 3) if finished else 0,
+                }
+            return metrics
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for jobs in self.waiting.values():
+                for job in jobs:
+                    job.future.cancel()
+            self.waiting.clear()
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+
+    def _dispatch(self, job):
+        self.executors[job.kind].submit(self._run, job)
+
+    def _run(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            self._finish(job)
+            return
+        start = time.time()
+        with self.lock:
+            self.running.add(job)
+        self._call_progress(job)
+        try:
+            result = job.function()
+        except BaseException as e:
+            failed = True
+            job.future.set_exception(e)
+        else:
+            failed = False
+            job.future.set_result(result)
+        finally:
+            with self.lock:
+                self.running.discard(job)
+                metrics = self.metrics[job.kind]
+                metrics['failed' if failed else 'completed'] += 1
+                metrics['wait_seconds'] += start - job.submitted
+                metrics['run_seconds'] += time.time() - start
+            self._finish(job)
+
+    def _finish(self, job):
+        key = (job.kind, job.user)
+        with self.lock:
+            waiting = self.waiting.get(key)
+            if waiting:
+                self._dispatch(waiting.popleft())
+                if not waiting:
+                    del self.waiting[key]
+            else:
+                self.active[key] -= 1
+                if not self.active[key]:
+                    del self.active[key]
+
+    def _report_progress(self):
+        # Telegram shows a chat action for five seconds, so it is repeated while the job is running
+        while not self.closed:
+            time.sleep(MEDIA_PROGRESS_INTERVAL_SECONDS)
+            with self.lock:
+                jobs = [job for job in self.running if job.progress]
+            for job in jobs:
+                self._call_progress(job)
+
+    def _call_progress(self, job):
+        if not job.progress:
+            return
+        try:
+            job.progress()
+        except Exception as e:
+            logger.warning('Could not report progress of %s job', job.kind, exc_info=e)
+
+
+_media_jobs = None
+_media_jobs_lock = threading.Lock()
+
+
+def get_media_jobs():
+    global _media_jobs
+    with _media_jobs_lock:
+        if _media_jobs is None:
+            _media_jobs = MediaJobs(MEDIA_JOB_WORKERS, MEDIA_JOBS_PER_USER)
+        return _media_jobs
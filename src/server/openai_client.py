@@ -0,0 +1,404 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+from openai import OpenAI, APIConnectionError, APIStatusError
+
+from consts import OPENAI_TIMEOUTS, OPENAI_CONNECT_TIMEOUT, OPENAI_MAX_CONNECTIONS, OPENAI_MAX_KEEPALIVE_CONNECTIONS, \
+    OPENAI_MAX_RETRIES, OPENAI_BACKOFF_BASE_SECONDS, OPENAI_BACKOFF_MAX_SECONDS, CIRCUIT_BREAKER_WINDOW_SECONDS, \
+    CIRCUIT_BREAKER_MIN_CALLS, CIRCUIT_BREAKER_FAILURE_RATE, CIRCUIT_BREAKER_COOLDOWN_SECONDS, \
+    CIRCUIT_BREAKER_HALF_OPEN_PROBES, CIRCUIT_BREAKER_SLOW_CALL_SECONDS, OPENAI_FALLBACK_MODELS, CHAT_HEDGING_ENABLED, \
+    CHAT_HEDGING_WORKERS, CHAT_HEDGING_PERCENTILE, CHAT_HEDGING_MIN_SAMPLES, CHAT_HEDGING_MIN_DELAY_SECONDS, \
+    CHAT_LATENCY_SAMPLES
+from server.usage_ledger import get_usage_ledger
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = {408, 409, 429}
+
+
+class UpstreamUnavailableError(Exception):
+
+    def __init__(self, message='OpenAI is having problems right now, please try again in a few minutes.'):
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, slow_call_seconds):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.outcomes = deque()
+        self.opened_at = 0
+        self.running_probes = 0
+        # Changes with every state, so results of calls admitted in an earlier state are ignored
+        self.generation = 0
+
+    def is_available(self):
+        with self.lock:
+            return self.state != CircuitBreaker.OPEN or self._cooldown_over()
+
+    def allow_request(self):
+        # Returns the generation to pass to record, or None if the request is rejected
+        with self.lock:
+            if self.state == CircuitBreaker.OPEN:
+                if not self._cooldown_over():
+                    return None
+                logger.info('Circuit breaker %s is half open, sending probe', self.name)
+                self._set_state(CircuitBreaker.HALF_OPEN)
+                self.running_probes = 0
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if self.running_probes >= CIRCUIT_BREAKER_HALF_OPEN_PROBES:
+                    return None
+                self.running_probes += 1
+            return self.generation
+
+    def record(self, generation, latency, failed):
+        failed = failed or latency > self.slow_call_seconds
+        with self.lock:
+            if generation != self.generation:
+                return
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.running_probes -= 1
+                if failed:
+                    self._open()
+                else:
+                    logger.info('Circuit breaker %s closed again', self.name)
+                    self._set_state(CircuitBreaker.CLOSED)
+                    self.outcomes.clear()
+                return
+            now = time.time()
+            self.outcomes.append((now, failed))
+            while self.outcomes and self.outcomes[0][0] < now - CIRCUIT_BREAKER_WINDOW_SECONDS:
+                self.outcomes.popleft()
+            if self.state == CircuitBreaker.CLOSED and len(self.outcomes) >= CIRCUIT_BREAKER_MIN_CALLS:
+                failure_rate = sum(1 for _, x in self.outcomes if x) / len(self.outcomes)
+                if failure_rate >= CIRCUIT_BREAKER_FAILURE_RATE:
+                    self._open()
+
+    def _open(self):
+        logger.warning('Circuit breaker %s opened, shedding requests for %s seconds', self.name,
+                       CIRCUIT_BREAKER_COOLDOWN_SECONDS)
+        self._set_state(CircuitBreaker.OPEN)
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+    def _set_state(self, state):
+        self.state = state
+        self.generation += 1
+
+    def _cooldown_over(self):
+        return time.time() - self.opened_at >= CIRCUIT_BREAKER_COOLDOWN_SECONDS
+
+
+class EndpointMetrics:
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'retries': self.retries,
+            'avg_latency': self.total_latency / self.requests if self.requests else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+
+class OpenAIClient:
+
+    def __init__(self, api_key):
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(max(OPENAI_TIMEOUTS.values()), connect=OPENAI_CONNECT_TIMEOUT),
+        )
+        # Retries are handled here, so that every endpoint shares the same backoff policy and metrics.
+        self.openai = OpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+        self.metrics_lock = threading.Lock()
+        self.metrics = {}
+        self.breakers_lock = threading.Lock()
+        self.breakers = {}
+        self.chat_latencies = {}
+        self.hedging_executor = ThreadPoolExecutor(max_workers=CHAT_HEDGING_WORKERS, thread_name_prefix='hedge')
+        self.hedging_stats = {'hedged': 0, 'hedge_wins': 0, 'wasted_tokens': 0}
+
+    def chat(self, usage_context=None, **kwargs):
+        model = self._available_chat_model(kwargs['model'])
+        if model != kwargs['model']:
+            logger.warning('Model %s is unavailable, falling back to %s', kwargs['model'], model)
+            kwargs['model'] = model
+        start = time.time()
+        result = self._call('chat', 'chat.completions', model, lambda client: client.chat.completions.create(**kwargs),
+                            usage_context)
+        with self.metrics_lock:
+            self.chat_latencies.setdefault(model, deque(maxlen=CHAT_LATENCY_SAMPLES)).append(time.time() - start)
+        return result
+
+    def chat_stream(self, usage_context=None, usage_callback=None, deadline=None, **kwargs):
+        model = self._available_chat_model(kwargs['model'])
+        kwargs['model'] = model
+        start = time.time()
+        try:
+            stream = self._call_with_retries(
+                'chat', 'chat.completions', model,
+                lambda client: client.chat.completions.create(stream=True, stream_options={'include_usage': True},
+                                                              **self._with_deadline(deadline, kwargs)),
+                deadline)
+        except Exception:
+            get_usage_ledger().record('chat.completions', model, usage_context, time.time() - start, failed=True)
+            raise
+        usage = None
+        content_length = 0
+        failed = False
+        try:
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content_length += len(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            # Complete responses are comparable to the ones of chat, hedging uses their latency
+            with self.metrics_lock:
+                self.chat_latencies.setdefault(model, deque(maxlen=CHAT_LATENCY_SAMPLES)).append(time.time() - start)
+        except GeneratorExit:
+            logger.info('Stopped streaming response from %s early', model)
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Closing the stream aborts the generation, which does not report usage in that case. The prompt is
+            # billed anyway, so it is estimated like the completion.
+            stream.close()
+            prompt_tokens = usage.prompt_tokens if usage else \
+                sum(len(message.get('content') or '') for message in kwargs['messages']) // 4
+            completion_tokens = usage.completion_tokens if usage else content_length // 4
+            get_usage_ledger().record(
+                'chat.completions', model, usage_context, time.time() - start, failed=failed,
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+            )
+            if usage_callback:
+                usage_callback(prompt_tokens, completion_tokens)
+
+    def chat_hedged(self, **kwargs):
+        delay = self._hedge_delay(kwargs['model'])
+        if not CHAT_HEDGING_ENABLED or delay is None:
+            return self.chat(**kwargs)
+        primary = self.hedging_executor.submit(self.chat, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        hedge_model = OPENAI_FALLBACK_MODELS.get(kwargs['model'], kwargs['model'])
+        logger.info('No response from %s within %.1f seconds, send hedged request to %s', kwargs['model'], delay,
+                    hedge_model)
+        hedge = self.hedging_executor.submit(self.chat, **dict(kwargs, model=hedge_model))
+        with self.metrics_lock:
+            self.hedging_stats['hedged'] += 1
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((x for x in done if x.exception() is None), None)
+            if winner is not None or not pending:
+                break
+        if winner is None:
+            return primary.result()
+        for loser in {primary, hedge} - {winner}:
+            loser.add_done_callback(self._record_hedge_waste)
+        if winner is hedge:
+            with self.metrics_lock:
+                self.hedging_stats['hedge_wins'] += 1
+        return winner.result()
+
+    def image(self, usage_context=None, **kwargs):
+        return self._call('image', 'images.generate', kwargs.get('model'),
+                          lambda client: client.images.generate(**kwargs), usage_context, units=kwargs.get('n', 1))
+
+    def transcribe(self, usage_context=None, duration=0, **kwargs):
+        def create(client):
+            self._rewind_files(kwargs)
+            return client.audio.transcriptions.create(**kwargs)
+
+        return self._call('audio', 'audio.transcriptions', kwargs.get('model'), create, usage_context,
+                          units=duration / 60)
+
+    def speech(self, usage_context=None, **kwargs):
+        return self._call('audio', 'audio.speech', kwargs.get('model'),
+                          lambda client: client.audio.speech.create(**kwargs), usage_context,
+                          units=len(kwargs['input']) / 1000)
+
+    def is_chat_available(self, model):
+        return self._breaker('chat', 'chat.completions', self._available_chat_model(model)).is_available()
+
+    def get_metrics(self):
+        with self.breakers_lock:
+            breaker_states = {name: breaker.state for name, breaker in self.breakers.items()}
+        with self.metrics_lock:
+            metrics = {endpoint: metrics.as_dict() for endpoint, metrics in self.metrics.items()}
+        for name, state in breaker_states.items():
+            metrics.setdefault(name, EndpointMetrics().as_dict())['circuit'] = state
+        with self.metrics_lock:
+            metrics['hedging'] = dict(self.hedging_stats)
+        return metrics
+
+    def close(self):
+        logger.info('OpenAI endpoint metrics: %s', self.get_metrics())
+        self.hedging_executor.shutdown(wait=False)
+        self.http_client.close()
+
+    def _hedge_delay(self, model):
+        with self.metrics_lock:
+            latencies = sorted(self.chat_latencies.get(model, []))
+        if len(latencies) < CHAT_HEDGING_MIN_SAMPLES:
+            return None
+        percentile = latencies[min(len(latencies) - 1, int(len(latencies) * CHAT_HEDGING_PERCENTILE))]
+        return max(CHAT_HEDGING_MIN_DELAY_SECONDS, percentile)
+
+    def _record_hedge_waste(self, future):
+        if future.exception() is not None:
+            return
+        usage = future.result().usage
+        if usage is not None:
+            logger.info('Discarded hedged response used %s tokens', usage.total_tokens)
+            with self.metrics_lock:
+                self.hedging_stats['wasted_tokens'] += usage.total_tokens
+
+    def _available_chat_model(self, model):
+        fallback = OPENAI_FALLBACK_MODELS.get(model)
+        if fallback is None or self._breaker('chat', 'chat.completions', model).is_available():
+            return model
+        return fallback
+
+    def _breaker(self, operation, endpoint, model):
+        name = f'{endpoint}:{model}' if model else endpoint
+        with self.breakers_lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, CIRCUIT_BREAKER_SLOW_CALL_SECONDS[operation])
+            return self.breakers[name]
+
+    def _call(self, operation, endpoint, model, request, usage_context, units=0):
+        start = time.time()
+        try:
+            result = self._call_with_retries(operation, endpoint, model, request)
+        except Exception:
+            get_usage_ledger().record(endpoint, model, usage_context, time.time() - start, failed=True)
+            raise
+        usage = getattr(result, 'usage', None)
+        get_usage_ledger().record(
+            endpoint, model, usage_context, time.time() - start, failed=False,
+            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+            completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+            units=units,
+        )
+        return result
+
+    def _with_deadline(self, deadline, kwargs):
+        # The read timeout applies to every chunk, so the stream cannot stall beyond the deadline
+        if deadline is None:
+            return kwargs
+        return dict(kwargs, timeout=httpx.Timeout(max(1.0, deadline - time.time()), connect=OPENAI_CONNECT_TIMEOUT))
+
+    def _call_with_retries(self, operation, endpoint, model, request, deadline=None):
+        breaker = self._breaker(operation, endpoint, model)
+        client = self.openai.with_options(
+            timeout=httpx.Timeout(OPENAI_TIMEOUTS[operation], connect=OPENAI_CONNECT_TIMEOUT))
+        attempt = 0
+        while True:
+            generation = breaker.allow_request()
+            if generation is None:
+                logger.warning('Circuit breaker %s is open, failing fast', breaker.name)
+                raise UpstreamUnavailableError()
+            start = time.time()
+            try:
+                result = request(client)
+            except Exception as e:
+                upstream_failure = self._should_retry(e)
+                breaker.record(generation, time.time() - start, failed=upstream_failure)
+                self._record(endpoint, time.time() - start, failed=True)
+                if attempt >= OPENAI_MAX_RETRIES or not upstream_failure:
+                    raise
+                delay = self._backoff_delay(attempt, e)
+                if deadline is not None and time.time() + delay >= deadline:
+                    raise
+                logger.warning('Call to %s failed (%s), retry %s in %.1f seconds', endpoint, e, attempt + 1, delay)
+                with self.metrics_lock:
+                    self.metrics[endpoint].retries += 1
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record(generation, time.time() - start, failed=False)
+            self._record(endpoint, time.time() - start)
+            return result
+
+    def _record(self, endpoint, latency, failed=False):
+        with self.metrics_lock:
+            metrics = self.metrics.setdefault(endpoint, EndpointMetrics())
+            metrics.requests += 1
+            metrics.total_latency += latency
+            metrics.max_latency = max(metrics.max_latency, latency)
+            if failed:
+                metrics.failures += 1
+
+    def _should_retry(self, error):
+        if isinstance(error, APIConnectionError):
+            # Also covers timeouts
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code in RETRY_STATUS_CODES or error.status_code >= 500
+        return False
+
+    def _backoff_delay(self, attempt, error):
+        delay = min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt)
+        if isinstance(error, APIStatusError):
+            try:
+                retry_after = float(error.response.headers.get('retry-after', 0))
+            except ValueError:
+                retry_after = 0
+            if 0 < retry_after <= OPENAI_BACKOFF_MAX_SECONDS:
+                return retry_after
+        # Full jitter, so that chats which failed together do not retry together
+        return random.uniform(0, delay)
+
+    def _rewind_files(self, kwargs):
+        for value in kwargs.values():
+            # Files can also be passed as (name, file) tuples
+            for item in value if isinstance(value, tuple) else [value]:
+                if hasattr(item, 'seek'):
+                    item.seek(0)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAIClient(api_key=os.environ['OPENAI_API_KEY'])
+        return _client
+
+
+def close_openai_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
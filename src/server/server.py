@@ -9,8 +9,15 @@ from multiprocessing.pool import ThreadPool
 
 import dotenv
 
-from consts import SOCKET_NAME, DATA_DIR
+from agent.tools.registry import load_plugins
+from consts import SOCKET_NAME, DATA_DIR, AGENT_TOOL_PLUGINS
+from server.completion_cache import get_completion_cache
+from server.dalle import get_image_cache
+from server.media_jobs import get_media_jobs
+from server.openai_client import close_openai_client
 from server.telegram import Telegram
+from server.usage_ledger import get_usage_ledger
+from server.whisper import get_tts_cache
 
 dotenv.load_dotenv('secrets.env')
 
@@ -54,7 +61,8 @@ def setup_telegram():
     telegram = Telegram(
         bot_token=os.environ['TELEGRAM_TOKEN'],
         webhook=os.environ['TELEGRAM_WEBHOOK'],
-        allowed_users=os.environ['ALLOWED_USERS'].split(',')
+        allowed_users=os.environ['ALLOWED_USERS'].split(','),
+        admin_users=[x for x in os.environ.get('ADMIN_USERS', '').split(',') if x],
     )
     telegram.setup()
     os.makedirs(DATA_DIR, exist_ok=True)
@@ -72,6 +80,7 @@ def start_server(telegram, thread_pool):
 
 
 def run_server():
+    load_plugins(AGENT_TOOL_PLUGINS)
     logger.info('Setup telegram')
     telegram = setup_telegram()
 
@@ -91,6 +100,16 @@ def run_server():
     thread_pool.join()
     logger.info('Shutting down server')
     server.shutdown()
+    # Chat workers still submit media jobs while they finish, so they have to stop first
     logger.info('Shutting down telegram')
     telegram.close()
+    logger.info('Shutting down media jobs')
+    get_media_jobs().close()
+    logger.info('Media job stats: %s', get_media_jobs().get_metrics())
+    logger.info('Completion cache stats: %s', get_completion_cache().get_stats())
+    logger.info('TTS cache stats: %s', get_tts_cache().get_stats())
+    logger.info('Image cache stats: %s', get_image_cache().get_stats())
+    logger.info('Shutting down OpenAI client')
+    close_openai_client()
+    get_usage_ledger().close()
     logger.info('Finished shutdown')
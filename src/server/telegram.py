@@ -1,14 +1,25 @@
 import json
 import logging
+import os
 import random
 import string
 import threading
 import time
+from collections import OrderedDict
 
 import requests
 
+from consts import USAGE_REPORT_DAYS, MAX_MESSAGE_LENGTH, MAX_AUDIO_FILE_BYTES, IMAGE_URL_LIFETIME_SECONDS, \
+    IMAGE_MAX_VARIANTS, UPDATE_DEDUP_PATH, UPDATE_DEDUP_SECONDS, UPDATE_DEDUP_BUCKET_SECONDS, \
+    UPDATE_DEDUP_MAX_UPDATES, UPDATE_DEDUP_FLUSH_SECONDS, UPDATE_DEDUP_LOCK_STRIPES, DATA_DIR, USER_CACHE_SIZE, \
+    USER_SETTINGS_FLUSH_SECONDS, USER_EVICT_MIN_IDLE_SECONDS, THREAD_PAGE_SIZE, THREAD_RECENT_MAX, \
+    MAX_CALLBACK_DATA_BYTES
 from server.chatgpt import ChatGPT
-from server.dalle import DallE
+from server.completion_cache import get_completion_cache
+from server.dalle import DallE, get_image_cache
+from server.media_jobs import get_media_jobs
+from server.openai_client import UpstreamUnavailableError, get_openai_client
+from server.usage_ledger import get_usage_ledger
 from server.whisper import Whisper
 
 logger = logging.getLogger(__name__)
@@ -19,7 +30,23 @@ class TelegramError(Exception):
 
 
 commands = {}
+admin_commands = {}
 callbacks = {}
+# Persisted settings of a user with their defaults, only the ones which differ from the default are stored
+USER_SETTINGS = {
+    'dalle_model': 'dall-e-2',
+    'dalle2_size': '256x256',
+    'dalle3_size': '1024x1024',
+    'dalle3_quality': 'standard',
+    'dalle3_style': 'natural',
+    'dalle_prompt': False,
+    'dalle_imgurl': False,
+    'dalle_variants': 1,
+    'tts_model': 'tts-1',
+    'tts_voice': 'echo',
+    'tts_all': False,
+    'chat_hedging': False,
+}
 
 
 def command(description, order):
@@ -32,6 +59,11 @@ def command(description, order):
     return inner
 
 
+def admin_command(f):
+    admin_commands[f.__name__] = f
+    return f
+
+
 def callback(cmd):
     def inner(f):
         callbacks[cmd] = f
@@ -42,16 +74,126 @@ def callback(cmd):
 
 class UpdateDeduplicator:
 
-    def __init__(self):
-        self.lock = threading.Lock()
-        self.processed_updates = {}
+    def __init__(self, path=None):
+        self.path = path
+        # Only updates with the same id can race, so they share a lock
+        self.locks = [threading.Lock() for _ in range(UPDATE_DEDUP_LOCK_STRIPES)]
+        self.rotate_lock = threading.Lock()
+        # (start, update ids), newest first. Replaced as a whole on rotation, so lookups need no global lock.
+        self.buckets = ((time.time(), set()),)
+        # (update id, time it was last seen) of the newest update which was dropped from the buckets. Update ids
+        # only increase while updates keep coming, so older ids count as processed until the watermark expires.
+        self.watermark = (-1, 0)
+        self.dirty = False
+        self.flush_lock = threading.Lock()
+        self.flush_thread = None
+        self._load()
 
     def deduplicate(self, update_id):
-        with self.lock:
-            if self.processed_updates.get(update_id, 0) + 60 * 60 * 24 > time.time():
+        self._rotate()
+        with self.locks[update_id % len(self.locks)]:
+            buckets = self.buckets
+            if self._below_watermark(update_id) or any(update_id in update_ids for _, update_ids in buckets):
                 return True
-            self.processed_updates[update_id] = time.time()
-            return False
+            buckets[0][1].add(update_id)
+            self.dirty = True
+        if self.path and self.flush_thread is None:
+            with self.rotate_lock:
+                if self.flush_thread is None:
+                    self.flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+                    self.flush_thread.start()
+        return False
+
+    def flush(self):
+        if not self.path or not self.dirty:
+            return
+        with self.flush_lock:
+            with self.rotate_lock:
+                self.dirty = False
+                watermark, watermark_time = self.watermark
+                data = {
+                    'watermark': watermark,
+                    'watermark_time': watermark_time,
+                    'buckets': [[start, self._to_ranges(update_ids.copy())] for start, update_ids in self.buckets],
+                }
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        self.flush()
+
+    def _below_watermark(self, update_id):
+        # After a long pause Telegram may start again with a random lower id, so the watermark is only trusted
+        # within the deduplication window
+        watermark, watermark_time = self.watermark
+        return update_id <= watermark and watermark - update_id < UPDATE_DEDUP_MAX_UPDATES and \
+            time.time() - watermark_time < UPDATE_DEDUP_SECONDS
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(UPDATE_DEDUP_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Could not save processed updates', exc_info=e)
+
+    def _rotate(self):
+        now = time.time()
+        if now - self.buckets[0][0] < UPDATE_DEDUP_BUCKET_SECONDS:
+            return
+        with self.rotate_lock:
+            buckets = self.buckets
+            if now - buckets[0][0] < UPDATE_DEDUP_BUCKET_SECONDS:
+                return
+            kept = []
+            total = 0
+            for start, update_ids in buckets:
+                total += len(update_ids)
+                if now - start >= UPDATE_DEDUP_SECONDS or (kept and total > UPDATE_DEDUP_MAX_UPDATES):
+                    break
+                kept.append((start, update_ids))
+            expired = [(start, update_ids) for start, update_ids in buckets[len(kept):] if update_ids]
+            if expired:
+                # The watermark has to move before the buckets are dropped. Updates are only added to a bucket
+                # during its first UPDATE_DEDUP_BUCKET_SECONDS.
+                start, update_ids = expired[0]
+                self.watermark = (max(update_ids), start + UPDATE_DEDUP_BUCKET_SECONDS)
+            self.buckets = ((now, set()),) + tuple(kept)
+            self.dirty = True
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Could not load processed updates', exc_info=e)
+            return
+        # Older files have no time for the watermark, so it is not trusted
+        self.watermark = (data['watermark'], data.get('watermark_time', 0))
+        buckets = tuple((start, self._from_ranges(ranges)) for start, ranges in data['buckets'])
+        if buckets:
+            self.buckets = buckets
+        self._rotate()
+        logger.info('Loaded %s processed updates', sum(len(update_ids) for _, update_ids in self.buckets))
+
+    @staticmethod
+    def _to_ranges(update_ids):
+        # Update ids are mostly consecutive, so they are stored as [first, last] ranges
+        ranges = []
+        for update_id in sorted(update_ids):
+            if ranges and ranges[-1][1] == update_id - 1:
+                ranges[-1][1] = update_id
+            else:
+                ranges.append([update_id, update_id])
+        return ranges
+
+    @staticmethod
+    def _from_ranges(ranges):
+        return {update_id for first, last in ranges for update_id in range(first, last + 1)}
 
 
 class ChatGPTManager:
@@ -71,6 +213,11 @@ class ChatGPTManager:
     def get_chatgpt_for_message(self, message) -> ChatGPT:
         return self.get_chatgpt(message['chat']['id'])
 
+    def is_active(self, chatid):
+        # Called while the user manager is locked, which get_chatgpt locks while holding the lock here
+        instance = self.chatgpt_instances.get(chatid)
+        return instance is not None and instance.is_active()
+
     def close(self):
         for instance in self.chatgpt_instances.values():
             instance.close()
@@ -81,47 +228,152 @@ class TelegramUserManager:
     def __init__(self, telegram):
         self.telegram = telegram
         self.lock = threading.Lock()
-        self.user_instances = {}
+        # Least recently used first
+        self.user_instances = OrderedDict()
+        self.known_chats = set()
+        self.dirty_users = {}
+        # Evicted users whose settings are still being written, they are used again if the chat comes back
+        self.evicted_users = {}
+        self.flush_thread = None
+        # Keeps the order of settings writes of the same user
+        self.save_lock = threading.Lock()
 
     def get_user(self, chatid):
+        user = self._get_loaded_user(chatid)
+        if user is not None:
+            return user
+        # Settings are only loaded when the user is used for the first time
+        settings = self._load_settings(chatid)
         with self.lock:
-            if chatid not in self.user_instances:
-                self.user_instances[chatid] = TelegramUser(self.telegram, chatid)
-            return self.user_instances[chatid]
+            user = self.user_instances.get(chatid) or self.evicted_users.get(chatid) or \
+                TelegramUser(self.telegram, chatid, settings)
+            self.user_instances[chatid] = user
+            self.user_instances.move_to_end(chatid)
+            self.known_chats.add(chatid)
+            user.last_used = time.time()
+            evicted = self._evict()
+        for evicted_user in evicted:
+            self._save_settings(evicted_user)
+            with self.lock:
+                if self.evicted_users.get(evicted_user.chatid) is evicted_user:
+                    del self.evicted_users[evicted_user.chatid]
+        return user
 
     def is_chat_known(self, chatid):
         with self.lock:
-            return chatid in self.user_instances
+            return chatid in self.known_chats or os.path.exists(self._settings_path(chatid))
 
     def get_user_for_message(self, message):
         return self.get_user(message['chat']['id'])
 
+    def mark_dirty(self, user):
+        with self.lock:
+            self.dirty_users[user.chatid] = user
+            if self.flush_thread is None:
+                self.flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+                self.flush_thread.start()
+
+    def flush(self):
+        with self.lock:
+            dirty_users = self.dirty_users
+            self.dirty_users = {}
+        for user in dirty_users.values():
+            self._save_settings(user)
+
+    def close(self):
+        self.flush()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(USER_SETTINGS_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Could not save user settings', exc_info=e)
+
+    def _get_loaded_user(self, chatid):
+        with self.lock:
+            user = self.user_instances.get(chatid)
+            if user is not None:
+                self.user_instances.move_to_end(chatid)
+                user.last_used = time.time()
+            return user
+
+    def _evict(self):
+        # Returns the evicted users whose settings still have to be written, which happens outside of the lock
+        evicted = []
+        if len(self.user_instances) <= USER_CACHE_SIZE:
+            return evicted
+        now = time.time()
+        for chatid, user in list(self.user_instances.items()):
+            if len(self.user_instances) <= USER_CACHE_SIZE:
+                break
+            # Users which are in use would otherwise end up with two instances. A user which was just handed out
+            # might not be locked yet.
+            if user.lock.locked() or user.open_command or self.telegram.chatgpt_manager.is_active(chatid) or \
+                    now - user.last_used < USER_EVICT_MIN_IDLE_SECONDS:
+                continue
+            if chatid in self.dirty_users:
+                self.evicted_users[chatid] = self.dirty_users.pop(chatid)
+                evicted.append(user)
+            del self.user_instances[chatid]
+        return evicted
+
+    def _settings_path(self, chatid):
+        return os.path.join(DATA_DIR, f'{chatid}_settings.json')
+
+    def _load_settings(self, chatid):
+        path = self._settings_path(chatid)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Could not load settings for chat %s', chatid, exc_info=e)
+            return {}
+
+    def _save_settings(self, user):
+        with self.save_lock:
+            with user.lock:
+                settings = user.get_settings()
+            path = self._settings_path(user.chatid)
+            if settings:
+                # Written to a temporary file first, so a crash does not leave a partial file behind
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(settings, f)
+                os.replace(path + '.tmp', path)
+            elif os.path.exists(path):
+                os.remove(path)
+
 
 class TelegramUser:
+    __slots__ = ('telegram', 'chatid', 'lock', 'open_command', 'settings_before', 'last_used') + tuple(USER_SETTINGS)
 
-    def __init__(self, telegram, chatid):
+    def __init__(self, telegram, chatid, settings=None):
         self.telegram = telegram
         self.chatid = chatid
         self.lock = threading.Lock()
-        self.dalle_model = 'dall-e-2'
-        self.dalle2_size = '256x256'
-        self.dalle3_size = '1024x1024'
-        self.dalle3_quality = 'standard'
-        self.dalle3_style = 'natural'
-        self.dalle_prompt = False
-        self.dalle_imgurl = False
-        self.tts_model = 'tts-1'
-        self.tts_voice = 'echo'
-        self.tts_all = False
         self.open_command = None
+        self.settings_before = None
+        self.last_used = time.time()
+        settings = settings or {}
+        for name, default in USER_SETTINGS.items():
+            setattr(self, name, settings.get(name, default))
+
+    def get_settings(self):
+        return {name: getattr(self, name) for name, default in USER_SETTINGS.items() if getattr(self, name) != default}
 
     def send_message(self, text):
         self.telegram._send_message(self.chatid, text)
 
-    def send_reply(self, text):
-        self.send_message(text)
-        if self.tts_all:
-            self.telegram.whisper.create_tts(text, self.tts_model, self.tts_voice, lambda f: self.telegram._send_voice(self.chatid, f))
+    def create_tts_pipeline(self):
+        if not self.tts_all:
+            return None
+        return self.telegram.whisper.create_tts_pipeline(
+            self.tts_model, self.tts_voice, lambda voice: self.telegram._send_voice(self.chatid, voice), self.chatid,
+            usage_context={'user': self.chatid, 'purpose': 'tts'},
+            progress=lambda: self.telegram._send_chat_action(self.chatid, 'record_voice'), hold=True)
 
     def dalle_size(self):
         if self.dalle_model == 'dall-e-2':
@@ -149,20 +401,26 @@ class TelegramUser:
 
     def __enter__(self):
         self.lock.acquire()
+        self.settings_before = self.get_settings()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        changed = self.get_settings() != self.settings_before
+        self.settings_before = None
         self.lock.release()
+        if changed:
+            self.telegram.user_manager.mark_dirty(self)
 
 
 class Telegram:
 
-    def __init__(self, bot_token, webhook, allowed_users):
+    def __init__(self, bot_token, webhook, allowed_users, admin_users=()):
         self.bot_token = bot_token
         self.webhook = webhook
         self.allowed_users = set(int(x) for x in allowed_users)
+        self.admin_users = set(int(x) for x in admin_users)
         self.secret_token = ''.join(random.choice(string.ascii_letters) for _ in range(32))
-        self.deduplicator = UpdateDeduplicator()
+        self.deduplicator = UpdateDeduplicator(UPDATE_DEDUP_PATH)
         self.chatgpt_manager = ChatGPTManager(self)
         self.dalle = DallE()
         self.whisper = Whisper()
@@ -182,6 +440,8 @@ class Telegram:
 
     def close(self):
         self.chatgpt_manager.close()
+        self.user_manager.close()
+        self.deduplicator.close()
 
     def handle_update_safe(self, update, secret_token):
         try:
@@ -204,7 +464,11 @@ class Telegram:
             # Make sure the user instance exists, is needed for authentication of callback_query
             self.user_manager.get_user_for_message(message)
             logger.info('Received message from user %s, chat %s', message['from']['id'], message['chat']['id'])
-            self._handle_message(message)
+            try:
+                self._handle_message(message)
+            except UpstreamUnavailableError as e:
+                logger.warning('Failed fast handling message, upstream is unavailable')
+                self._reply(message, str(e))
         if 'callback_query' in update:
             callback = update['callback_query']
             self._post('answerCallbackQuery', callback_query_id=callback['id'])
@@ -295,6 +559,16 @@ class Telegram:
         new_model = data['new_model']
         self.chatgpt_manager.get_chatgpt_for_message(message).set_model(new_model)
 
+    @command('Switch hedging slow requests with a faster model', 19)
+    def hedge(self, message):
+        with self.user_manager.get_user_for_message(message) as user:
+            user.chat_hedging = not user.chat_hedging
+            new_chat_hedging = user.chat_hedging
+        if new_chat_hedging:
+            self._reply(message, 'Changed setting. Will send a second request if the answer takes too long.')
+        else:
+            self._reply(message, 'Changed setting. Will wait for the answer of the selected model.')
+
     @command('Remind you of the last few messages', 13)
     def remindme(self, message):
         amount = self._get_command_argument(message, '/remindme')
@@ -306,25 +580,88 @@ class Telegram:
 
     @command('Change the current thread', 11)
     def thread(self, message):
+        # The argument is either the number of recent threads to list or a prefix of the thread name
+        argument = self._get_command_argument(message, '/thread')
         chatgpt = self.chatgpt_manager.get_chatgpt_for_message(message)
-        current_thread_id = chatgpt.get_current_thread_id()
-        threads = chatgpt.get_thread_names()
-        reply = f'The title of the current thread is "{threads[current_thread_id]}".' \
-                f'\n\nSelect a thread to switch to.'
-        buttons = [[{
-            'text': threads[thread_id],
-            'callback_data': json.dumps({
-                'cmd': 'switch_thread',
-                'new_thread_id': thread_id,
-            }),
-        }] for thread_id in threads]
-        self._reply_keyboard(message, reply, self._with_cancel_button(buttons))
+        current_name = chatgpt.get_thread_name(chatgpt.get_current_thread_id())
+        if argument.isdigit():
+            count = max(1, min(int(argument), THREAD_RECENT_MAX))
+            reply, buttons = self._recent_threads_page(chatgpt, count)
+        elif argument and argument != message['text']:
+            reply, buttons = self._prefix_threads_page(chatgpt, argument, 0)
+        else:
+            reply, buttons = self._recent_threads_page(chatgpt, THREAD_PAGE_SIZE)
+        self._reply_keyboard(message, f'The title of the current thread is "{current_name}".\n\n' + reply,
+                             self._with_cancel_button(buttons))
 
     @callback('switch_thread')
     def thread_callback(self, message, data):
         new_thread_id = data['new_thread_id']
         self.chatgpt_manager.get_chatgpt_for_message(message).switch_thread(new_thread_id)
 
+    @callback('thread_page')
+    def thread_page_callback(self, message, data):
+        chatgpt = self.chatgpt_manager.get_chatgpt_for_message(message)
+        current_name = chatgpt.get_thread_name(chatgpt.get_current_thread_id())
+        if 'prefix' in data:
+            reply, buttons = self._prefix_threads_page(chatgpt, data['prefix'], data['offset'])
+        else:
+            reply, buttons = self._recent_threads_page(chatgpt, data['count'], data.get('after'), data.get('before'))
+        self._update_reply_keyboard(message, f'The title of the current thread is "{current_name}".\n\n' + reply,
+                                    self._with_cancel_button(buttons))
+
+    def _recent_threads_page(self, chatgpt, count, after=None, before=None):
+        threads, has_newer, has_older = chatgpt.get_recent_threads(count, after, before)
+        navigation = []
+        if has_newer:
+            navigation.append(self._thread_page_button('« Newer', count=count, before=threads[0][0]))
+        if has_older:
+            navigation.append(self._thread_page_button('Older »', count=count, after=threads[-1][0]))
+        navigation = [button for button in navigation if button]
+        return 'Select a thread to switch to, most recently used first.', \
+            self._thread_buttons(threads) + ([navigation] if navigation else [])
+
+    def _prefix_threads_page(self, chatgpt, prefix, offset):
+        threads, total = chatgpt.get_threads_with_prefix(prefix, THREAD_PAGE_SIZE, offset)
+        if not total:
+            return f'There is no thread starting with "{prefix}".', []
+        if not threads:
+            # Threads were deleted since the page was shown, go back to the last page
+            offset = (total - 1) // THREAD_PAGE_SIZE * THREAD_PAGE_SIZE
+            threads, total = chatgpt.get_threads_with_prefix(prefix, THREAD_PAGE_SIZE, offset)
+        navigation = []
+        if offset > 0:
+            navigation.append(self._thread_page_button('« Previous', prefix=prefix,
+                                                       offset=max(0, offset - THREAD_PAGE_SIZE)))
+        if offset + THREAD_PAGE_SIZE < total:
+            navigation.append(self._thread_page_button('Next »', prefix=prefix, offset=offset + THREAD_PAGE_SIZE))
+        # Long prefixes do not fit into the callback data, those can only be narrowed down further
+        navigation = [button for button in navigation if button]
+        reply = f'Select a thread to switch to, {offset + 1}-{offset + len(threads)} of {total} ' \
+                f'threads starting with "{prefix}".'
+        return reply, self._thread_buttons(threads) + ([navigation] if navigation else [])
+
+    def _thread_buttons(self, threads):
+        return [[{
+            'text': name,
+            'callback_data': json.dumps({
+                'cmd': 'switch_thread',
+                'new_thread_id': thread_id,
+            }),
+        }] for thread_id, name in threads]
+
+    def _thread_page_button(self, text, **data):
+        callback_data = json.dumps({
+            'cmd': 'thread_page',
+            **data,
+        })
+        if len(callback_data.encode()) > MAX_CALLBACK_DATA_BYTES:
+            return None
+        return {
+            'text': text,
+            'callback_data': callback_data,
+        }
+
     @command('Use an agent to answer the prompt', 20)
     def agent(self, message):
         prompt = self._get_command_argument(message, '/agent')
@@ -345,19 +682,28 @@ class Telegram:
                 image_style = user.dalle3_style
                 reply_prompt = user.dalle_prompt
                 reply_imgurl = user.dalle_imgurl
-            self._chat_action(message, 'upload_photo')
-            if image_model == 'dall-e-2':
-                image_url = self.dalle.generate_image_v2(prompt, image_size)
-            elif image_model == 'dall-e-3':
-                image_url, revised_prompt = self.dalle.generate_image_v3(prompt, image_size, image_quality, image_style)
-                if reply_prompt:
+                image_variants = user.dalle_variants
+            def generate():
+                return self.dalle.create_images(image_model, prompt, image_size, image_quality, image_style,
+                                                image_variants, usage_context=self._usage_context(message, 'image'))
+
+            def deliver(images):
+                revised_prompts = [image.revised_prompt for image in images if image.revised_prompt is not None]
+                if reply_prompt and revised_prompts:
                     self._reply(message, "The prompt might have been changed. The actual prompt used:")
-                    self._reply(message, revised_prompt)
-            else:
-                raise ValueError()
-            if reply_imgurl:
-                self._reply(message, image_url)
-            self._reply_photo(message, image_url)
+                    for revised_prompt in revised_prompts:
+                        self._reply(message, revised_prompt)
+                if reply_imgurl:
+                    for image in images:
+                        self._reply_image_url(message, image)
+                if len(images) < image_variants:
+                    self._reply(message, f'Only {len(images)} of {image_variants} images could be generated.')
+                if len(images) == 1:
+                    self._reply_image(message, images[0])
+                else:
+                    self._reply_image_album(message, images)
+
+            self._submit_media_job(message, 'image', 'upload_photo', generate, deliver)
 
     @command('Select the image model to use', 41)
     def imgmodel(self, message):
@@ -464,6 +810,27 @@ class Telegram:
         else:
             self._reply(message, 'Changed setting. Will not send image url.')
 
+    @command('Adjust the number of images to generate', 47)
+    def imgvariants(self, message):
+        with self.user_manager.get_user_for_message(message) as user:
+            image_variants = user.dalle_variants
+        reply = f'Choose the number of images (currently {image_variants})'
+        buttons = [[{
+            'text': str(variants),
+            'callback_data': json.dumps({
+                'cmd': 'imgvariants',
+                'variants': variants,
+            }),
+        } for variants in range(1, IMAGE_MAX_VARIANTS + 1)]]
+        self._reply_keyboard(message, reply, self._with_cancel_button(buttons))
+
+    @callback('imgvariants')
+    def imgvariants_callback(self, message, data):
+        new_variants = data['variants']
+        with self.user_manager.get_user_for_message(message) as user:
+            user.dalle_variants = new_variants
+        self._reply(message, f'Changed number of images to {new_variants}.')
+
     @command('Transform text to speech', 50)
     def tts(self, message):
         prompt = self._get_command_argument(message, '/tts')
@@ -475,7 +842,13 @@ class Telegram:
             with self.user_manager.get_user_for_message(message) as user:
                 tts_model = user.tts_model
                 tts_voice = user.tts_voice
-            self.whisper.create_tts(prompt, tts_model, tts_voice, lambda f: self._reply_voice(message, f))
+            tts = self.whisper.create_tts_pipeline(tts_model, tts_voice,
+                                                   lambda voice: self._reply_voice(message, voice),
+                                                   message['chat']['id'],
+                                                   usage_context=self._usage_context(message, 'tts'),
+                                                   progress=lambda: self._chat_action(message, 'record_voice'))
+            tts.add_text(prompt)
+            tts.finish()
 
     @command('Select the tts model to use', 51)
     def ttsmodel(self, message):
@@ -529,21 +902,84 @@ class Telegram:
         else:
             self._reply(message, 'Changed setting. Will not send tts for all assistant replies.')
 
+    @command('Show your usage and costs', 80)
+    def usage(self, message):
+        report = get_usage_ledger().user_report(message['chat']['id'])
+        lines = [
+            '*Today*', self._format_usage(report['today']),
+            f'\n*Last {USAGE_REPORT_DAYS} days*', self._format_usage(report['recent']),
+        ]
+        for model, totals in sorted(report['recent_models'].items()):
+            lines.append(f'{model}: {self._format_usage(totals)}')
+        lines += ['\n*Total*', self._format_usage(report['total'])]
+        self._reply(message, '\n'.join(lines))
+
+    @admin_command
+    def usageall(self, message):
+        dump = {
+            'usage': get_usage_ledger().dump(),
+            'openai': get_openai_client().get_metrics(),
+            'completion_cache': get_completion_cache().get_stats(),
+            'media_jobs': get_media_jobs().get_metrics(),
+        }
+        text = json.dumps(dump, indent=1)
+        for start in range(0, len(text), MAX_MESSAGE_LENGTH):
+            self._reply(message, text[start:start + MAX_MESSAGE_LENGTH])
+
+    def _format_usage(self, totals):
+        return f'{totals.requests} requests, {totals.prompt_tokens + totals.completion_tokens} tokens, ' \
+               f'${totals.cost:.4f}, {totals.as_dict()["avg_latency"]}s average latency'
+
     def _handle_normal_message(self, message):
         self._chat_action(message, 'typing')
         self.chatgpt_manager.get_chatgpt_for_message(message).submit_message(message['text'])
 
-    def _handle_audio_file(self, message, file_id):
-        file_info = self._post('getFile', file_id=file_id)
-        file_path = file_info['file_path']
-        full_url = f'https://api.telegram.org/file/bot{self.bot_token}/{file_path}'
-        transcript = self.whisper.transcribe_url(full_url)
-        if not transcript:
-            self._reply(message, 'Sorry, I did not understand this.')
-            return
-        self._reply(message, f'*Transcript*\n\n{transcript}')
-        self._chat_action(message, 'typing')
-        self.chatgpt_manager.get_chatgpt_for_message(message).submit_message(transcript)
+    def _handle_audio_file(self, message, audio):
+        posted_partials = []
+
+        def post_partial(index, count, partial_transcript):
+            posted_partials.append(index)
+            self._reply(message, f'*Transcript {index + 1}/{count}*\n\n{partial_transcript}')
+
+        def transcribe():
+            file_info = self._post('getFile', file_id=audio['file_id'])
+            file_path = file_info['file_path']
+            full_url = f'https://api.telegram.org/file/bot{self.bot_token}/{file_path}'
+            return self.whisper.transcribe_url(full_url,
+                                               usage_context=self._usage_context(message, 'transcription'),
+                                               duration=audio.get('duration', 0), partial_callback=post_partial)
+
+        def deliver(transcript):
+            if not transcript:
+                self._reply(message, 'Sorry, I did not understand this.')
+                return
+            if not posted_partials:
+                self._reply(message, f'*Transcript*\n\n{transcript}')
+            self._chat_action(message, 'typing')
+            self.chatgpt_manager.get_chatgpt_for_message(message).submit_message(transcript)
+
+        self._submit_media_job(message, 'transcription', 'typing', transcribe, deliver)
+
+    def _submit_media_job(self, message, kind, action, job, deliver):
+        def done(future):
+            if future.cancelled():
+                # Waiting jobs are cancelled at shutdown
+                logger.info('Media job %s was cancelled', kind)
+                return
+            try:
+                deliver(future.result())
+            except UpstreamUnavailableError as e:
+                logger.warning('Failed fast handling %s job, upstream is unavailable', kind)
+                self._reply(message, str(e))
+            except Exception as e:
+                logger.error('Media job %s crashed', kind, exc_info=e)
+                self._reply(message, 'Sorry, I crashed. ' + str(e))
+
+        future = get_media_jobs().submit(kind, message['chat']['id'], job, lambda: self._chat_action(message, action))
+        future.add_done_callback(done)
+
+    def _usage_context(self, message, purpose):
+        return {'user': message['chat']['id'], 'purpose': purpose}
 
     def _get_command_argument(self, message, command_name):
         text = message['text']
@@ -577,10 +1013,12 @@ class Telegram:
     def _send_photo(self, chatid, photo_url, **kwargs):
         return self._post('sendPhoto', chat_id=chatid, photo=photo_url, **kwargs)
 
-    def _send_voice(self, chatid, voice_file, **kwargs):
-        logging.info('Sending voice file %s to chat %s', voice_file, chatid)
-        with open(voice_file, 'rb') as f:
-            return self._post('sendVoice', chat_id=chatid, files={'voice': f}, **kwargs)
+    def _send_voice(self, chatid, voice, **kwargs):
+        if isinstance(voice, str):
+            # Telegram file id of a voice message which was sent before
+            return self._post('sendVoice', chat_id=chatid, voice=voice, **kwargs)
+        logging.info('Sending voice message with %s bytes to chat %s', len(voice), chatid)
+        return self._post('sendVoice', chat_id=chatid, files={'voice': ('voice.ogg', voice, 'audio/ogg')}, **kwargs)
 
     def _reply(self, message, reply):
         return self._send_message(message['chat']['id'], reply)
@@ -590,14 +1028,84 @@ class Telegram:
             'inline_keyboard': buttons
         })
 
-    def _reply_photo(self, message, photo_url):
-        self._send_photo(message['chat']['id'], photo_url)
+    def _reply_photo(self, message, photo):
+        return self._send_photo(message['chat']['id'], photo)
+
+    def _reply_image(self, message, image):
+        cache = get_image_cache()
+        file_id = cache.get_metadata(image.key, 'file_id')
+        if file_id is not None:
+            try:
+                return self._reply_photo(message, file_id)
+            except TelegramError:
+                logger.warning('Failed to send cached photo, upload it again')
+                cache.set_metadata(image.key, file_id=None)
+        content = cache.get(image.key) if image.cached else None
+        if content is None:
+            return self._reply_photo(message, image.url)
+        result = self._post('sendPhoto', chat_id=message['chat']['id'],
+                            files={'photo': ('image.png', content, 'image/png')})
+        # Telegram returns several sizes of the photo, the last one is the largest
+        cache.set_metadata(image.key, file_id=result['photo'][-1]['file_id'])
+        return result
+
+    def _reply_image_album(self, message, images):
+        cache = get_image_cache()
+        file_ids = [cache.get_metadata(image.key, 'file_id') for image in images]
+        try:
+            result = self._send_image_album(message['chat']['id'], images, file_ids)
+        except TelegramError:
+            if not any(file_ids):
+                raise
+            logger.warning('Failed to send cached photos, upload them again')
+            for image in images:
+                cache.set_metadata(image.key, file_id=None)
+            file_ids = [None] * len(images)
+            result = self._send_image_album(message['chat']['id'], images, file_ids)
+        # Only the file ids of the request which went through are known to be valid
+        for image, file_id, sent_message in zip(images, file_ids, result):
+            if file_id is None and 'photo' in sent_message:
+                cache.set_metadata(image.key, file_id=sent_message['photo'][-1]['file_id'])
+        return result
+
+    def _send_image_album(self, chatid, images, file_ids):
+        cache = get_image_cache()
+        media = []
+        files = {}
+        for index, (image, file_id) in enumerate(zip(images, file_ids)):
+            content = cache.get(image.key) if file_id is None and image.cached else None
+            if file_id is not None:
+                media.append({'type': 'photo', 'media': file_id})
+            elif content is not None:
+                files[f'photo{index}'] = (f'image{index}.png', content, 'image/png')
+                media.append({'type': 'photo', 'media': f'attach://photo{index}'})
+            else:
+                media.append({'type': 'photo', 'media': image.url})
+        if files:
+            # Multipart requests can only contain strings besides the files
+            return self._post('sendMediaGroup', files=files, chat_id=chatid, media=json.dumps(media))
+        return self._post('sendMediaGroup', chat_id=chatid, media=media)
+
+    def _reply_image_url(self, message, image):
+        if time.time() - image.created < IMAGE_URL_LIFETIME_SECONDS:
+            self._reply(message, image.url)
+            return
+        content = get_image_cache().get(image.key)
+        if content is None:
+            self._reply(message, 'The link to the image has expired.')
+            return
+        self._reply(message, 'The link to the image has expired, here is the original file.')
+        self._post('sendDocument', chat_id=message['chat']['id'],
+                   files={'document': ('image.png', content, 'image/png')})
 
-    def _reply_voice(self, message, voice_file):
-        self._send_voice(message['chat']['id'], voice_file)
+    def _reply_voice(self, message, voice):
+        return self._send_voice(message['chat']['id'], voice)
+
+    def _send_chat_action(self, chatid, action):
+        self._post('sendChatAction', chat_id=chatid, action=action)
 
     def _chat_action(self, message, action):
-        self._post('sendChatAction', chat_id=message['chat']['id'], action=action)
+        self._send_chat_action(message['chat']['id'], action)
 
     def _update_reply(self, message, reply):
         return self._update_message(message['chat']['id'], message['message_id'], reply)
@@ -636,6 +1144,9 @@ class Telegram:
                 elif cmd == 'start':
                     self.start(message)
                     return
+                elif cmd in admin_commands and message['from']['id'] in self.admin_users:
+                    admin_commands[cmd](self, message)
+                    return
                 else:
                     logger.warning('Unknown bot command %s', cmd)
         open_command = None
@@ -650,15 +1161,17 @@ class Telegram:
 
     def _handle_audio_message(self, message):
         logger.info('Handle audio message')
-        if message['audio']['file_size'] > 15 * 1024 * 1024:
+        if message['audio'].get('file_size', 0) > MAX_AUDIO_FILE_BYTES:
             self._reply(message, 'Sorry, this file is too large.')
-        self._handle_audio_file(message, message['audio']['file_id'])
+            return
+        self._handle_audio_file(message, message['audio'])
 
     def _handle_voice_message(self, message):
         logger.info('Handle voice message')
-        if message['voice']['file_size'] > 15 * 1024 * 1024:
+        if message['voice'].get('file_size', 0) > MAX_AUDIO_FILE_BYTES:
             self._reply(message, 'Sorry, this file is too large.')
-        self._handle_audio_file(message, message['voice']['file_id'])
+            return
+        self._handle_audio_file(message, message['voice'])
 
     def _handle_callback(self, message, callback):
         data = json.loads(callback['data'])
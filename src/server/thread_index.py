@@ -0,0 +1,118 @@
+import threading
+from bisect import bisect_left, insort
+
+
+def _name_key(name):
+    return name.casefold()
+
+
+class ThreadIndex:
+    # Threads of one chat, ordered by last use and by name, so listing a page does not touch every thread
+
+    def __init__(self, threads):
+        self.lock = threading.Lock()
+        self.names = {}
+        # Doubly linked list by last use, most recent first
+        self.newer = {}
+        self.older = {}
+        self.newest = None
+        # (casefolded name, thread id), sorted for prefix lookups
+        self.by_name = []
+        for thread_id, value in sorted(threads.items(), key=lambda x: x[1].get('last_use', 0)):
+            self._push(thread_id)
+            self.names[thread_id] = value['name']
+            self.by_name.append((_name_key(value['name']), thread_id))
+        self.by_name.sort()
+
+    def add(self, thread_id, name):
+        with self.lock:
+            if thread_id in self.names:
+                self._unlink(thread_id)
+                self._remove_name(thread_id)
+            self._push(thread_id)
+            self.names[thread_id] = name
+            insort(self.by_name, (_name_key(name), thread_id))
+
+    def touch(self, thread_id):
+        with self.lock:
+            if thread_id in self.names:
+                self._unlink(thread_id)
+                self._push(thread_id)
+
+    def rename(self, thread_id, name):
+        with self.lock:
+            if thread_id in self.names:
+                self._remove_name(thread_id)
+                self.names[thread_id] = name
+                insort(self.by_name, (_name_key(name), thread_id))
+
+    def remove(self, thread_id):
+        with self.lock:
+            if thread_id in self.names:
+                self._unlink(thread_id)
+                self._remove_name(thread_id)
+                del self.names[thread_id]
+
+    def get_name(self, thread_id):
+        with self.lock:
+            return self.names.get(thread_id)
+
+    def count(self):
+        with self.lock:
+            return len(self.names)
+
+    def recent(self, count, after=None, before=None):
+        # Returns up to count threads used right before after (or right after before), most recent first,
+        # and whether there are more recent and less recent threads
+        with self.lock:
+            if before in self.names and self.newer[before] is not None:
+                threads = []
+                thread_id = self.newer[before]
+                while thread_id is not None and len(threads) < count:
+                    threads.append(thread_id)
+                    thread_id = self.newer[thread_id]
+                threads.reverse()
+            else:
+                # Start over when the cursor thread was deleted or became the most recent one in the meantime
+                thread_id = self.older[after] if after in self.names else self.newest
+                threads = []
+                while thread_id is not None and len(threads) < count:
+                    threads.append(thread_id)
+                    thread_id = self.older[thread_id]
+            if not threads:
+                return [], False, False
+            return ([(thread_id, self.names[thread_id]) for thread_id in threads],
+                    self.newer[threads[0]] is not None, self.older[threads[-1]] is not None)
+
+    def with_prefix(self, prefix, count, offset=0):
+        # Returns up to count threads whose name starts with prefix, ordered by name, and the number of matches
+        key = _name_key(prefix)
+        with self.lock:
+            start = bisect_left(self.by_name, (key,))
+            end = bisect_left(self.by_name, (key + chr(0x10ffff),))
+            threads = [(thread_id, self.names[thread_id])
+                       for _, thread_id in self.by_name[start + offset:min(end, start + offset + count)]]
+            return threads, end - start
+
+    def _push(self, thread_id):
+        self.older[thread_id] = self.newest
+        if self.newest is not None:
+            self.newer[self.newest] = thread_id
+        self.newer[thread_id] = None
+        self.newest = thread_id
+
+    def _unlink(self, thread_id):
+        newer = self.newer.pop(thread_id)
+        older = self.older.pop(thread_id)
+        if newer is None:
+            self.newest = older
+        else:
+            self.older[newer] = older
+        if older is not None:
+            self.newer[older] = newer
+
+    def _remove_name(self, thread_id):
+        entry = (_name_key(self.names[thread_id]), thread_id)
+        index = bisect_left(self.by_name, entry)
+        if index < len(self.by_name) and self.by_name[index] == entry:
+            del self.by_name[index]
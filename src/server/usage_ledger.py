@@ -0,0 +1,164 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from consts import USAGE_LEDGER_PATH, USAGE_TOKEN_PRICES, USAGE_UNIT_PRICES, USAGE_REPORT_DAYS
+
+logger = logging.getLogger(__name__)
+
+
+class UsageTotals:
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.latency = 0.0
+
+    def add(self, entry):
+        self.requests += 1
+        self.failures += 1 if entry['failed'] else 0
+        self.prompt_tokens += entry['prompt_tokens']
+        self.completion_tokens += entry['completion_tokens']
+        self.cost += entry['cost']
+        self.latency += entry['latency']
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.failures += other.failures
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cost += other.cost
+        self.latency += other.latency
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cost': round(self.cost, 4),
+            'avg_latency': round(self.latency / self.requests, 2) if self.requests else 0.0,
+        }
+
+
+class UsageLedger:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.per_user = defaultdict(UsageTotals)
+        self.per_model = defaultdict(UsageTotals)
+        self.per_purpose = defaultdict(UsageTotals)
+        # (user, day) -> model -> totals
+        self.per_user_day = defaultdict(lambda: defaultdict(UsageTotals))
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._replay()
+        self.file = open(self.path, 'a')
+
+    def record(self, endpoint, model, usage_context, latency, failed, prompt_tokens=0, completion_tokens=0,
+               units=0):
+        usage_context = usage_context or {}
+        entry = {
+            'time': time.time(),
+            'user': usage_context.get('user'),
+            'thread': usage_context.get('thread'),
+            'purpose': usage_context.get('purpose'),
+            'endpoint': endpoint,
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'units': units,
+            'cost': self._estimate_cost(model, prompt_tokens, completion_tokens, units),
+            'latency': round(latency, 3),
+            'failed': failed,
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self._aggregate(entry)
+
+    def user_report(self, user):
+        today = datetime.date.today()
+        first_day = (today - datetime.timedelta(days=USAGE_REPORT_DAYS - 1)).isoformat()
+        today = today.isoformat()
+        report = {'today': UsageTotals(), 'recent': UsageTotals(), 'recent_models': defaultdict(UsageTotals)}
+        with self.lock:
+            for (entry_user, day), models in self.per_user_day.items():
+                if entry_user != str(user) or day < first_day:
+                    continue
+                for model, totals in models.items():
+                    report['recent'].merge(totals)
+                    report['recent_models'][model].merge(totals)
+                    if day == today:
+                        report['today'].merge(totals)
+            total = UsageTotals()
+            total.merge(self.per_user[str(user)])
+        report['total'] = total
+        return report
+
+    def dump(self):
+        with self.lock:
+            return {
+                'users': {user: totals.as_dict() for user, totals in self.per_user.items()},
+                'models': {model: totals.as_dict() for model, totals in self.per_model.items()},
+                'purposes': {purpose: totals.as_dict() for purpose, totals in self.per_purpose.items()},
+            }
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _estimate_cost(self, model, prompt_tokens, completion_tokens, units):
+        if model in USAGE_TOKEN_PRICES:
+            prompt_price, completion_price = USAGE_TOKEN_PRICES[model]
+            return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        return units * USAGE_UNIT_PRICES.get(model, 0)
+
+    def _aggregate(self, entry):
+        user = str(entry['user'])
+        day = datetime.date.fromtimestamp(entry['time']).isoformat()
+        self.per_user[user].add(entry)
+        self.per_model[entry['model']].add(entry)
+        self.per_purpose[entry['purpose']].add(entry)
+        self.per_user_day[(user, day)][entry['model']].add(entry)
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        count = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self._aggregate(json.loads(line))
+                    count += 1
+                except (ValueError, KeyError) as e:
+                    logger.warning('Skip invalid usage ledger entry', exc_info=e)
+        logger.info('Replayed %s usage ledger entries', count)
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger(USAGE_LEDGER_PATH)
+        return _ledger
+
+
+def use_usage_ledger(path):
+    # Record to a different ledger, e.g. for benchmark runs against a stub endpoint
+    global _ledger
+    with _ledger_lock:
+        if _ledger is not None:
+            _ledger.close()
+        _ledger = UsageLedger(path)
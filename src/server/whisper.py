@@ -1,45 +1,373 @@
+import hashlib
+import io
 import logging
+import mmap
 import os
+import re
+import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
-from openai import OpenAI
 import pydub
+import pydub.silence
 import requests
 
+from cache import BlobCache
+from consts import WHISPER_DIRECT_FORMATS, WHISPER_MAX_UPLOAD_BYTES, WHISPER_DOWNLOAD_TIMEOUT_SECONDS, \
+    WHISPER_TRANSCODE_TIMEOUT_SECONDS, WHISPER_SEGMENT_SECONDS, WHISPER_PARALLELISM, WHISPER_SAMPLE_RATE, \
+    WHISPER_MIN_SILENCE_MS, WHISPER_SILENCE_THRESHOLD_DB, WHISPER_MAX_SEGMENTED_SECONDS, TTS_CHUNK_CHARS, \
+    TTS_MAX_INPUT_CHARS, TTS_CACHE_DIR, TTS_CACHE_MAX_DISK_BYTES, AUDIO_SPOOL_MEMORY_BYTES
+from server.media_jobs import get_media_jobs
+from server.openai_client import get_openai_client, UpstreamUnavailableError
+
 logger = logging.getLogger(__name__)
 
+TRANSCRIPTION_EXECUTOR = ThreadPoolExecutor(max_workers=WHISPER_PARALLELISM, thread_name_prefix='whisper')
+# The end of a sentence is only known once the next word starts
+SENTENCE_END = re.compile(r'[.!?](?=\s)|\n')
+
+_tts_cache = None
+_tts_cache_lock = threading.Lock()
+
+
+def get_tts_cache():
+    global _tts_cache
+    with _tts_cache_lock:
+        if _tts_cache is None:
+            _tts_cache = BlobCache(TTS_CACHE_DIR, TTS_CACHE_MAX_DISK_BYTES, 'ogg')
+        return _tts_cache
+
+
+def split_speech_chunks(text, first):
+    # Returns the chunks which are complete and the remaining text
+    chunks = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        min_length = 1 if first and not chunks else TTS_CHUNK_CHARS
+        if match.end() - start >= min_length and text[start:match.end()].strip():
+            chunks += _split_long_text(text[start:match.end()])
+            start = match.end()
+    remaining = text[start:]
+    if len(remaining) > TTS_MAX_INPUT_CHARS:
+        *long_chunks, remaining = _split_long_text(remaining)
+        chunks += long_chunks
+    return chunks, remaining
+
+
+def _split_long_text(text):
+    chunks = []
+    while len(text) > TTS_MAX_INPUT_CHARS:
+        cut = text.rfind(' ', 0, TTS_MAX_INPUT_CHARS)
+        if cut <= 0:
+            cut = TTS_MAX_INPUT_CHARS
+        chunks.append(text[:cut])
+        text = text[cut:]
+    chunks = [chunk.strip() for chunk in chunks + [text]]
+    return [chunk for chunk in chunks if chunk]
+
+
+class SpeechPipeline:
+    # Synthesizes text in chunks as it arrives and sends the audio in order as soon as it is ready.
+    # With hold, nothing is sent before release, so the audio does not arrive before the text it reads.
+
+    def __init__(self, whisper, model, voice, send_voice, user, usage_context=None, progress=None, hold=False):
+        self.whisper = whisper
+        self.model = model
+        self.voice = voice
+        self.send_voice = send_voice
+        self.user = user
+        self.usage_context = usage_context
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pending = ''
+        self.futures = []
+        self.next_to_send = 0
+        self.released = not hold
+
+    def add_text(self, text):
+        with self.lock:
+            self.pending += text
+            chunks, self.pending = split_speech_chunks(self.pending, first=not self.futures)
+            futures = [self._submit(chunk) for chunk in chunks]
+        self._watch(futures)
+
+    def finish(self):
+        with self.lock:
+            chunks = _split_long_text(self.pending) if self.pending.strip() else []
+            self.pending = ''
+            futures = [self._submit(chunk) for chunk in chunks]
+        self._watch(futures)
+
+    def release(self):
+        with self.lock:
+            self.released = True
+        self._send_ready()
+
+    def _submit(self, chunk):
+        future = get_media_jobs().submit('tts', self.user, lambda: self._synthesize(chunk), self.progress)
+        self.futures.append(future)
+        return future
+
+    def _synthesize(self, chunk):
+        # Audio which was already sent once is sent again by its Telegram file id
+        key = '\n'.join([self.model, self.voice, hashlib.sha256(chunk.encode()).hexdigest()])
+        cache = get_tts_cache()
+        file_id = cache.get_metadata(key, 'file_id')
+        if file_id is not None:
+            return key, file_id
+        content = cache.get(key)
+        if content is None:
+            content = self.whisper.synthesize(chunk, self.model, self.voice, self.usage_context)
+            cache.put(key, content)
+        return key, content
+
+    def _send_chunk(self, key, voice):
+        cache = get_tts_cache()
+        if isinstance(voice, str):
+            try:
+                self.send_voice(voice)
+                return
+            except Exception as e:
+                logger.warning('Failed to send cached voice file, upload it again', exc_info=e)
+                cache.set_metadata(key, file_id=None)
+                voice = cache.get(key)
+                if voice is None:
+                    raise
+        message = self.send_voice(voice)
+        if 'voice' in message:
+            cache.set_metadata(key, file_id=message['voice']['file_id'])
+
+    def _watch(self, futures):
+        # Outside of the lock, the callback runs right away if the future is already done
+        for future in futures:
+            future.add_done_callback(lambda _: self._send_ready())
+
+    def _send_ready(self):
+        with self.send_lock:
+            while True:
+                with self.lock:
+                    if not self.released or self.next_to_send >= len(self.futures) or \
+                            not self.futures[self.next_to_send].done():
+                        return
+                    future = self.futures[self.next_to_send]
+                    self.next_to_send += 1
+                try:
+                    self._send_chunk(*future.result())
+                except Exception as e:
+                    logger.warning('Failed to send speech chunk', exc_info=e)
+
 
 class Whisper:
 
     def __init__(self):
-        self.openai = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+        self.openai = get_openai_client()
+
+    def transcribe_url(self, url, usage_context=None, duration=0, partial_callback=None):
+        audio_format = os.path.splitext(urlparse(url).path)[1].lstrip('.').lower()
+        audio_file = self._download(url)
+        if audio_file is None:
+            return None
+        with audio_file:
+            if duration > WHISPER_SEGMENT_SECONDS:
+                transcript = self._transcribe_segmented(audio_file, usage_context, partial_callback)
+                if transcript is not None:
+                    return transcript
+                logger.warning('Could not split audio, transcribe it in one piece')
+            if audio_format not in WHISPER_DIRECT_FORMATS:
+                logger.info('Transcode %s file', audio_format or 'unknown')
+                transcoded_file = self._transcode(audio_file, 'mp3')
+                if transcoded_file is None:
+                    return None
+                with transcoded_file:
+                    return self._transcribe(transcoded_file, 'mp3', usage_context, duration)
+            return self._transcribe(audio_file, audio_format, usage_context, duration)
+
+    def create_tts_pipeline(self, model, voice, send_voice, user, usage_context=None, progress=None, hold=False):
+        return SpeechPipeline(self, model, voice, send_voice, user, usage_context, progress, hold)
+
+    def synthesize(self, message, model, voice, usage_context=None):
+        response = self.openai.speech(
+            usage_context=usage_context,
+            model=model,
+            input=message,
+            voice=voice,
+            response_format='opus',
+        )
+        return response.content
+
+    def _transcribe(self, audio_file, audio_format, usage_context, duration):
+        logger.info('Start transcribing')
+        # The name tells the endpoint which format the audio is in
+        transcript = self.openai.transcribe(usage_context=usage_context, duration=duration,
+                                            file=('voice.' + audio_format, audio_file), model='whisper-1')
+        logger.info('Finished transcribing')
+        return transcript.text
+
+    def _transcribe_segmented(self, audio_file, usage_context, partial_callback):
+        pcm_file = self._transcode(audio_file, 's16le', ['-ac', '1', '-ar', str(WHISPER_SAMPLE_RATE)],
+                                   WHISPER_MAX_SEGMENTED_SECONDS * WHISPER_SAMPLE_RATE * 2)
+        if pcm_file is None:
+            return None
+        with pcm_file:
+            if isinstance(pcm_file, io.BytesIO):
+                pcm = pcm_file.getvalue()
+            elif os.fstat(pcm_file.fileno()).st_size:
+                # Long recordings are mapped from the temporary file instead of being read into memory
+                pcm = mmap.mmap(pcm_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                pcm = b''
+            try:
+                return self._transcribe_pcm(pcm, usage_context, partial_callback)
+            finally:
+                if isinstance(pcm, mmap.mmap):
+                    pcm.close()
+
+    def _transcribe_pcm(self, pcm, usage_context, partial_callback):
+        if not pcm:
+            return None
+        audio = pydub.AudioSegment(data=pcm, sample_width=2, frame_rate=WHISPER_SAMPLE_RATE, channels=1)
+        segments = self._split_audio(audio)
+        logger.info('Start transcribing %s segments', len(segments))
+        # Segments are only copied out of the audio when they are transcribed
+        futures = [TRANSCRIPTION_EXECUTOR.submit(self._transcribe_segment, audio, start, end, usage_context)
+                   for start, end in segments]
+        transcripts = []
+        failed = 0
+        for index, future in enumerate(futures):
+            try:
+                transcript = future.result()
+            except UpstreamUnavailableError:
+                for remaining in futures:
+                    remaining.cancel()
+                raise
+            except Exception as e:
+                logger.warning('Failed to transcribe segment %s', index, exc_info=e)
+                failed += 1
+                transcripts.append('[...]')
+                continue
+            transcripts.append(transcript)
+            # Segments are reported in order, as soon as all earlier ones are done. Failed ones are left out, if all
+            # of them fail the caller gets the transcript of the fallback instead.
+            if partial_callback:
+                partial_callback(index, len(segments), transcript)
+        logger.info('Finished transcribing, %s segments failed', failed)
+        if failed == len(segments):
+            return None
+        return ' '.join(transcripts)
+
+    def _transcribe_segment(self, audio, start, end, usage_context):
+        segment = audio[start:end]
+        audio_file = io.BytesIO()
+        segment.export(audio_file, format='wav')
+        return self._transcribe(audio_file, 'wav', usage_context, segment.duration_seconds)
 
-    def transcribe_url(self, url):
-        with tempfile.TemporaryDirectory() as tempdir:
-            response = requests.get(url)
+    def _split_audio(self, audio):
+        max_length = WHISPER_SEGMENT_SECONDS * 1000
+        silences = pydub.silence.detect_silence(audio, min_silence_len=WHISPER_MIN_SILENCE_MS,
+                                                silence_thresh=audio.dBFS + WHISPER_SILENCE_THRESHOLD_DB,
+                                                seek_step=50)
+        cuts = [(start + end) // 2 for start, end in silences]
+        segments = []
+        start = 0
+        while len(audio) - start > max_length:
+            # Cut at the last silence in the second half of the segment, or in the middle of a word if there is none
+            candidates = [cut for cut in cuts if start + max_length // 2 <= cut <= start + max_length]
+            end = candidates[-1] if candidates else start + max_length
+            segments.append((start, end))
+            start = end
+        segments.append((start, len(audio)))
+        return segments
+
+    def _download(self, url):
+        with requests.get(url, stream=True, timeout=WHISPER_DOWNLOAD_TIMEOUT_SECONDS) as response:
             if not response.ok:
                 logger.warning('Failed to download file')
                 return None
-            original_file = os.path.join(tempdir, 'voice')
-            with open(original_file, 'wb') as f:
-                f.write(response.content)
-            destination_file = os.path.join(tempdir, 'voice.mp3')
-            pydub.AudioSegment.from_file(original_file).export(destination_file, format='mp3')
-            logger.info('Start transcribing')
-            with open(destination_file, 'rb') as f:
-                transcript = self.openai.audio.transcriptions.create(file=f, model='whisper-1')
-            logger.info('Finished transcribing')
-            return transcript.text
-
-    def create_tts(self, message, model, voice, callback):
-        with tempfile.TemporaryDirectory() as tempdir:
-            response = self.openai.audio.speech.create(
-                model=model,
-                input=message,
-                voice=voice,
-                response_format='opus',
-            )
-            voice_file = os.path.join(tempdir, 'voice.ogg')
-            with open(voice_file, 'wb') as f:
-                f.write(response.content)
-            callback(voice_file)
+            if int(response.headers.get('Content-Length') or 0) > WHISPER_MAX_UPLOAD_BYTES:
+                logger.warning('File is too large to transcribe')
+                return None
+            audio_file = io.BytesIO()
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > WHISPER_MAX_UPLOAD_BYTES:
+                    logger.warning('File is too large to transcribe')
+                    audio_file.close()
+                    return None
+                audio_file = self._spooled_write(audio_file, chunk)
+            audio_file.seek(0)
+            return audio_file
+
+    @staticmethod
+    def _spooled_write(audio_file, chunk):
+        # Larger audio is moved from memory to a temporary file
+        if isinstance(audio_file, io.BytesIO) and audio_file.tell() + len(chunk) > AUDIO_SPOOL_MEMORY_BYTES:
+            spooled_file = tempfile.TemporaryFile()
+            spooled_file.write(audio_file.getbuffer())
+            audio_file.close()
+            audio_file = spooled_file
+        audio_file.write(chunk)
+        return audio_file
+
+    def _transcode(self, audio_file, audio_format, options=(), max_bytes=WHISPER_MAX_UPLOAD_BYTES):
+        audio_file.seek(0)
+        # A spooled file can be passed to ffmpeg directly, an in-memory one is written to the pipe
+        in_memory = isinstance(audio_file, io.BytesIO)
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                process = subprocess.Popen(
+                    ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', *options, '-f', audio_format,
+                     'pipe:1'],
+                    stdin=subprocess.PIPE if in_memory else audio_file, stdout=subprocess.PIPE, stderr=stderr)
+            except OSError as e:
+                logger.warning('Failed to transcode file', exc_info=e)
+                return None
+            if in_memory:
+                threading.Thread(target=self._write_input, args=(process.stdin, audio_file.getvalue()),
+                                 daemon=True).start()
+            start = time.time()
+            timer = threading.Timer(WHISPER_TRANSCODE_TIMEOUT_SECONDS, process.kill)
+            timer.start()
+            # The output is checked while it is read, so ffmpeg is stopped before a huge output is buffered
+            output = io.BytesIO()
+            size = 0
+            try:
+                while True:
+                    chunk = process.stdout.read(64 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        logger.warning('Transcoded file is too large to transcribe')
+                        process.kill()
+                        output.close()
+                        return None
+                    output = self._spooled_write(output, chunk)
+            finally:
+                timer.cancel()
+                process.stdout.close()
+                returncode = process.wait()
+            if time.time() - start >= WHISPER_TRANSCODE_TIMEOUT_SECONDS:
+                logger.warning('Transcoding timed out')
+                output.close()
+                return None
+            if returncode != 0:
+                stderr.seek(0)
+                logger.warning('Failed to transcode file: %s', stderr.read().decode(errors='replace').strip())
+                output.close()
+                return None
+        output.seek(0)
+        return output
+
+    @staticmethod
+    def _write_input(pipe, content):
+        try:
+            pipe.write(content)
+            pipe.close()
+        except OSError:
+            # ffmpeg stopped reading, its exit code tells why
+            pass